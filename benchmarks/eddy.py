@@ -0,0 +1,95 @@
+"""
+Wall time of the eddy stage (dwifslpreproc) against the number of threads and the correction tier,
+on a small synthetic DWI, to size the allocations of a cohort.
+Run from the repository root: python benchmarks/eddy.py --threads 1 2 4 8
+Without dwifslpreproc and mrconvert on the PATH only the commands are printed.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.preprocesses import EDDY_TIERS, eddy_interface  # noqa: E402
+
+
+def synthetic_dwi(folder, shape, n_directions, b_value=1000.0) -> str:
+    """
+    A DWI with two b0 volumes and n_directions diffusion weighted volumes of an ellipsoid with
+    anisotropic diffusion, noise and a slight shift per volume, converted to .mif with its gradients.
+    """
+    rng = np.random.default_rng(0)
+    directions = rng.normal(size=(n_directions, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    bvecs = np.vstack([np.zeros((2, 3)), directions])
+    bvals = np.r_[0.0, 0.0, np.full(n_directions, b_value)]
+
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"), axis=-1)
+    inside = (grid ** 2 / np.array([0.8, 0.9, 0.7]) ** 2).sum(axis=-1) < 1
+    diffusivity = np.array([1.7e-3, 0.4e-3, 0.4e-3])
+
+    volumes = []
+    for index, (bvec, bval) in enumerate(zip(bvecs, bvals)):
+        signal = 1000.0 * np.exp(-bval * (diffusivity * bvec ** 2).sum()) * inside
+        signal = np.roll(signal, index % 2, axis=1)
+        volumes.append(signal + rng.normal(scale=20.0, size=shape))
+    data = np.abs(np.stack(volumes, axis=-1)).astype(np.float32)
+
+    nifti = os.path.join(folder, "dwi.nii.gz")
+    nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0])).to_filename(nifti)
+    np.savetxt(os.path.join(folder, "dwi.bvec"), bvecs.T, fmt="%.6f")
+    np.savetxt(os.path.join(folder, "dwi.bval"), bvals[None], fmt="%d")
+
+    mif = os.path.join(folder, "dwi.mif")
+    if shutil.which("mrconvert"):
+        subprocess.run(["mrconvert", nifti, mif, "-fslgrad", os.path.join(folder, "dwi.bvec"),
+                        os.path.join(folder, "dwi.bval"), "-quiet", "-force"], check=True)
+    return mif
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=3, default=[48, 48, 30])
+    parser.add_argument('--directions', type=int, default=12)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--tiers', nargs='+', default=list(EDDY_TIERS), choices=list(EDDY_TIERS))
+    parser.add_argument('--readout_time', type=float, default=0.05)
+    args = parser.parse_args()
+
+    has_tools = shutil.which("dwifslpreproc") is not None and shutil.which("mrconvert") is not None
+    with tempfile.TemporaryDirectory() as tmp:
+        mif = synthetic_dwi(tmp, tuple(args.shape), args.directions)
+        print(f"Synthetic DWI {'x'.join(str(n) for n in args.shape)} with {args.directions + 2} volumes")
+
+        print(f"{'tier':<10}{'threads':>8}{'wall s':>10}{'speedup':>9}")
+        for tier in args.tiers:
+            baseline = None
+            for threads in args.threads:
+                run_dir = os.path.join(tmp, f"{tier}_{threads}")
+                os.makedirs(run_dir)
+                os.chdir(run_dir)
+                eddy = eddy_interface(threads, tier)
+                eddy.inputs.in_file = mif if has_tools else os.path.join(tmp, "dwi.nii.gz")
+                eddy.inputs.pe_dir = "j"
+                eddy.inputs.ro_time = args.readout_time
+                if not has_tools:
+                    print(f"{tier:<10}{threads:>8}  OMP_NUM_THREADS={threads} {eddy.cmdline}")
+                    continue
+
+                start = time.perf_counter()
+                eddy.run()
+                wall = time.perf_counter() - start
+                baseline = baseline or wall
+                print(f"{tier:<10}{threads:>8}{wall:>10.1f}{baseline / wall:>9.2f}")
+        os.chdir(os.path.dirname(tmp))
+
+
+if __name__ == "__main__":
+    main()
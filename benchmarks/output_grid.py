@@ -0,0 +1,75 @@
+"""
+Output size and runtime of the DWI in T1 space for the selectable output grids.
+Run from the repository root: python benchmarks/output_grid.py
+Without antsApplyTransforms on the PATH only the grid sizes are reported.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.resampling import build_reference_grid, run_apply_transforms  # noqa: E402
+
+
+def synthetic_images(folder, n_volumes, t1_mm, dwi_mm) -> tuple:
+    fov = np.array([176.0, 240.0, 240.0])
+
+    t1_shape = np.round(fov / t1_mm).astype(int)
+    t1_affine = np.diag([t1_mm, t1_mm, t1_mm, 1.0])
+    t1_affine[:3, 3] = -fov / 2
+    t1 = os.path.join(folder, "t1.nii.gz")
+    nib.Nifti1Image(np.random.rand(*t1_shape).astype(np.float32), t1_affine).to_filename(t1)
+
+    dwi_shape = tuple(np.round(fov / dwi_mm).astype(int)) + (n_volumes,)
+    dwi_affine = np.diag([dwi_mm, dwi_mm, dwi_mm, 1.0])
+    dwi_affine[:3, 3] = -fov / 2
+    dwi = os.path.join(folder, "dwi.nii.gz")
+    nib.Nifti1Image(np.random.rand(*dwi_shape).astype(np.float32), dwi_affine).to_filename(dwi)
+    return t1, dwi
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--volumes', type=int, default=30)
+    parser.add_argument('--t1_mm', type=float, default=1.0)
+    parser.add_argument('--dwi_mm', type=float, default=2.0)
+    parser.add_argument('--spacing', type=float, default=1.5, help='spacing of the "custom" grid')
+    parser.add_argument('--ncpus', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    has_ants = shutil.which("antsApplyTransforms") is not None
+    with tempfile.TemporaryDirectory() as tmp:
+        t1, dwi = synthetic_images(tmp, args.volumes, args.t1_mm, args.dwi_mm)
+        os.chdir(tmp)
+
+        print(f"{'grid':<8}{'shape':<18}{'grid s':>8}{'voxels':>14}{'raw MB':>10}{'out MB':>10}{'resample s':>12}")
+        for grid, spacing in [("t1", None), ("dwi", None), ("custom", [args.spacing])]:
+            start = time.perf_counter()
+            reference = build_reference_grid(t1, dwi, grid, spacing)
+            grid_time = time.perf_counter() - start
+
+            shape = nib.load(reference).shape[:3]
+            voxels = int(np.prod(shape)) * args.volumes
+            raw_mb = voxels * 4 / 1024 ** 2
+
+            out_mb, resample_time = float("nan"), float("nan")
+            if has_ants:
+                out_file = os.path.join(tmp, f"warped_{grid}.nii.gz")
+                start = time.perf_counter()
+                run_apply_transforms(dwi, reference, ["identity"], out_file, num_threads=args.ncpus)
+                resample_time = time.perf_counter() - start
+                out_mb = os.path.getsize(out_file) / 1024 ** 2
+
+            print(f"{grid:<8}{str(shape):<18}{grid_time:>8.3f}{voxels:>14}{raw_mb:>10.1f}{out_mb:>10.1f}"
+                  f"{resample_time:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
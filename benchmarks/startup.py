@@ -0,0 +1,73 @@
+"""
+Startup time of the command line: main.py --help, the imports of the workflow modules,
+and the construction of the workflow graph for a growing number of subjects.
+Run from the repository root: python benchmarks/startup.py
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def time_command(command, repeats) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def write_anatomy(bids_dir, subjects) -> None:
+    # empty T1w and T2w files, the graph is built from the file names only
+    for subject in subjects:
+        anat = os.path.join(bids_dir, f"sub-{subject}", "anat")
+        os.makedirs(anat, exist_ok=True)
+        for suffix in ("T1w", "T2w"):
+            open(os.path.join(anat, f"sub-{subject}_{suffix}.nii.gz"), "w").close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--subjects', type=int, nargs='+', default=[1, 10, 100])
+    args = parser.parse_args()
+
+    print(f"{'step':<36}{'seconds':>10}")
+    print(f"{'main.py --help':<36}{time_command([sys.executable, 'main.py', '--help'], args.repeats):>10.3f}")
+    print(f"{'import modules.pipeline':<36}"
+          f"{time_command([sys.executable, '-c', 'import modules.pipeline'], args.repeats):>10.3f}")
+
+    from shared_core.project_parser import Parser
+    from modules.anatomy import anatomy_groups
+    from modules.pipeline import build_workflow
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sys.argv = ["main.py", "-i", tmp]
+        pipeline_args = Parser().parse()
+        write_anatomy(tmp, ["00"] + [f"{i:03d}" for i in range(max(args.subjects))])
+
+        start = time.perf_counter()
+        build_workflow(pipeline_args, tmp, ["00"], os.path.join(tmp, "scrap"), anatomy=anatomy_groups(tmp, ["00"]))
+        print(f"{'first build (tool probing)':<36}{time.perf_counter() - start:>10.3f}")
+
+        for n in args.subjects:
+            subjects = [f"{i:03d}" for i in range(n)]
+            anatomy = anatomy_groups(tmp, subjects)
+            start = time.perf_counter()
+            wf = build_workflow(pipeline_args, tmp, subjects, os.path.join(tmp, "scrap"), anatomy=anatomy)
+            built = time.perf_counter() - start
+            wf._create_flat_graph()
+            flat = time.perf_counter() - start
+            print(f"{f'build {n} subjects':<36}{built:>10.3f}")
+            print(f"{f'build and flatten {n} subjects':<36}{flat:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
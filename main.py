@@ -1,22 +1,28 @@
 import os.path as op
 import shutil
-
-from nipype.pipeline.engine import Workflow
+import sys
 
 from shared_core.project_parser import Parser
-from shared_core.dicom_conversion import DICOM
-from shared_core.bids_checks import BIDS
-from shared_core.utils import continuously_ask_user_yn, execution_time
+from shared_core.utils import continuously_ask_user_yn, execution_time, load_answers, MissingAnswerError
 
-from modules.data_handler import data_source, bids_grabber, data_sink, mif_input_combiner, get_meta_parameters
-from modules.preprocesses import preprocess_dwi_workflow, preprocess_anat_workflow
-from modules.registration import registration_workflow
+# nipype, pybids and the interfaces take seconds to import, so they are imported only
+# in the code paths that need them, and --help or an argument error returns right away
 
 
 @execution_time
 def main():
     parser = Parser()
     args = parser.parse()
+    if args.config:
+        load_answers(args.config)
+
+    # a worker only needs the queue, the coordinator has done the checks already
+    if args.worker:
+        from shared_core.work_queue import WorkQueue
+        from modules.pipeline import run_worker
+
+        run_worker(args, WorkQueue(op.join(args.output, "queue"), args.lease_seconds))
+        return
 
     # detect the subjects in the input directory
     subjects = parser.get_subjects()
@@ -25,65 +31,158 @@ def main():
 
     # IF DICOM files are found, convert them to NIFTI
     # and create a BIDS directory structure for the data
-    dicom = DICOM(args, subjects)
-    out_folder = dicom.run_conversion()
+    # (planning, merging and QC only read an existing BIDS dataset and never convert)
+    if args.plan or args.merge or args.qc == "only":
+        out_folder = args.input
+    else:
+        from shared_core.dicom_conversion import DICOM
+
+        dicom = DICOM(args, subjects)
+        out_folder = dicom.run_conversion()
+
+    from shared_core.bids_checks import BIDS
+    from modules.data_handler import validate_outputs, bids_units, split_unit
 
     # check if the BIDS directory structure is valid
     bids = BIDS(out_folder, subjects)
     bids.run_check()
-    subjects = bids.get_bids_subjects()
+    # from here on, every session of a subject with sessions is a unit of its own, "<subject>_ses-<session>"
+    subjects = bids_units(bids.get_layout(), bids.get_bids_subjects())
+    if args.subjects_file:
+        with open(args.subjects_file) as f:
+            listed = {line.strip() for line in f if line.strip()}
+        # a subject stands for all its sessions
+        subjects = [unit for unit in subjects if unit in listed or split_unit(unit)[0] in listed]
+        print(f"{len(subjects)} units listed in {args.subjects_file}")
 
     # Get final output folder
     out_folder = bids.get_work_dir()
-    scrap_directory = op.join(out_folder, "scrap")
-
-    # IO nodes
-    source_iterator = data_source(subjects)
-    bids_source = bids_grabber(out_folder)
-    sink = data_sink(out_folder, args.output)
-
-    # define main processing modules (workflows)
-    combine_dwi = mif_input_combiner(args.ncpus)
-    meta_parameters = get_meta_parameters()
-    preprocess_dwi = preprocess_dwi_workflow(args.ncpus)
-    preprocess_anat = preprocess_anat_workflow(args.ncpus)
-    registration = registration_workflow(args.ncpus)
-
-    print(f"Starting workflow with {args.ncpus} threads")
-    wf = Workflow(name="pipeline_registration", base_dir=scrap_directory)
-    if args.debug:
-        wf.config['execution'] = {'stop_on_first_crash': 'True'}
-
-    # define the workflow with the modules and correctly define interconnections
-    wf.connect([
-        (source_iterator, bids_source, [("subject", "subject")]),
-        (bids_source, combine_dwi, [("dwi", "inputnode.dwi"),
-                                    ("bvec", "inputnode.bvec"),
-                                    ("bval", "inputnode.bval")]),
-        (bids_source, meta_parameters, [("dwi_meta", "meta_path")]),
-        (combine_dwi, preprocess_dwi, [("outputnode.dwi", "inputnode.dwi")]),
-        (meta_parameters, preprocess_dwi, [("pe", "inputnode.pe"),
-                                           ("rt", "inputnode.rt")]),
-        (bids_source, preprocess_anat, [("T1w", "inputnode.t1"),
-                                        ("T2w", "inputnode.t2")]),
-
-        (preprocess_dwi, registration, [("outputnode.mean_b0", "inputnode.mean_b0"),
-                                        ("outputnode.dwi_nifti", "inputnode.dwi_nifti")]),
-        (preprocess_anat, registration, [("outputnode.t1", "inputnode.t1"),
-                                         ("outputnode.t2", "inputnode.t2")]),
-
-        (preprocess_anat, sink, [("outputnode.t1", "anat.@t1")]),
-        (registration, sink, [("outputnode.dwi", "dwi.@dwi"),
-                              ("outputnode.t2", "anat.@t2")]),
-        (preprocess_dwi, sink, [("outputnode.bvec", "dwi.@dwi_bvec"),
-                                ("outputnode.bval", "dwi.@dwi_bval")])
-    ])
+    scrap_directory = op.join(args.scratch or out_folder, "scrap")
+
+    if args.merge:
+        incomplete = validate_outputs(args.output, subjects, args.output_mode)
+        for subject, missing in incomplete.items():
+            print(f"Subject {subject} is missing: {', '.join(missing)}")
+        print(f"{len(subjects) - len(incomplete)} of {len(subjects)} subjects complete in {args.output}")
+        if incomplete:
+            sys.exit(1)
+        return
+
+    # the metrics of all subjects from their outputs, and the temporary files still there
+    if args.qc == "only":
+        from modules.qc import run_qc
+
+        run_qc(args.output, subjects, scrap_directory, args.ncpus)
+        return
+
+    from modules.pipeline import build_workflow, run_subjects, run_staged, watch, unit_groups
+    from modules.metadata import sidecar_table
+    from modules.preflight import preflight, report_preflight, preflight_rows
+    from modules.planning import (CostModel, subject_sizes, load_node_timings, record_node_timings, plan_cohort,
+                                  print_plan, write_table, anatomy_savings, print_anatomy_savings)
+    from modules.anatomy import anatomy_groups, set_unit_order
+    from modules.progress import ProgressMonitor, ProgressRecorder, progress_plan, run_name
+    from modules.scheduling import order_subjects, makespan_report, print_makespan_report
+
+    # process the existing subjects that have no outputs yet, then everything that arrives later
+    if args.watch:
+        incomplete = validate_outputs(args.output, subjects, args.output_mode)
+        watch(args, out_folder, scrap_directory, [subject for subject in subjects if subject not in incomplete])
+        return
+
+    # every shard works on its own subjects and in its own scratch directory
+    if parser.is_sharded():
+        # sessions sharing an anatomical pair go to the same shard, which runs their anatomical branch once
+        subjects = parser.select_shard(unit_groups(out_folder, subjects))
+        scrap_directory = op.join(scrap_directory, parser.shard_name())
+        print(f"Shard {parser.shard_name()}: {subjects}")
+        if not subjects:
+            print("No subjects in this shard")
+            return
+
+    # header-only checks, subjects with missing or inconsistent inputs are left out before anything runs
+    metadata = sidecar_table(out_folder, subjects, args.output, args.ncpus)
+    if args.preflight != "off":
+        results = preflight(bids.get_layout(), subjects, metadata, args.ncpus, args.dwi_runs)
+        write_table(preflight_rows(results), op.join(args.output, "preflight.tsv"))
+        subjects = report_preflight(results)
+        if not subjects:
+            print("No subjects passed the preflight checks")
+            return
+
+    # the anatomical branch runs once per T1w/T2w pair, for all the sessions sharing it
+    anatomy = anatomy_groups(out_folder, subjects)
+    paired = {unit for group in anatomy.values() for unit in group["units"]}
+    for unit in subjects:
+        if unit not in paired:
+            print(f"Subject {unit}: no T1w and T2w, left out")
+    subjects = [unit for unit in subjects if unit in paired]
+    if not subjects:
+        print("No subjects with a T1w and a T2w")
+        return
+    wf = build_workflow(args, out_folder, subjects, scrap_directory, anatomy=anatomy)
+
+    # header-only estimates, calibrated by the node timings of earlier runs
+    sizes = subject_sizes(bids.get_layout(), subjects, args)
+    model = CostModel(load_node_timings(args.output))
+    subject_rows, node_rows = plan_cohort(wf, sizes, model, anatomy)
+    anatomy_rows = anatomy_savings(wf, anatomy, sizes, model)
+    print_anatomy_savings(anatomy_rows)
+    write_table(anatomy_rows, op.join(args.output, "anatomy.tsv"))
+    costs = {row["subject"]: row["wall_hours"] for row in subject_rows}
+    subjects = order_subjects(subjects, costs, args.order)
+    set_unit_order(wf, subjects, anatomy)
+
+    if args.queue:
+        from shared_core.work_queue import WorkQueue
+
+        queue = WorkQueue(op.join(args.output, "queue"), args.lease_seconds)
+        # the sessions sharing an anatomical pair are one item, so their anatomical branch runs once
+        published = queue.publish([{"id": units[0], "units": units, "bids_dir": out_folder,
+                                    "scrap_directory": scrap_directory}
+                                   for units in unit_groups(out_folder, subjects)])
+        print(f"Queued {published} items in {queue.queue_dir}, start the workers with --worker")
+        return
+
+    if args.plan:
+        print_plan(subject_rows, model)
+        print_makespan_report(makespan_report(subjects, costs, args.parallel_subjects), args.parallel_subjects)
+        write_table(subject_rows, op.join(args.output, "plan.tsv"))
+        write_table(node_rows, op.join(args.output, "plan_nodes.tsv"))
+        return
+
+    if args.monitor:
+        from nipype import config
+        config.enable_resource_monitor()
 
     # Run main workflow
-    wf.run()
+    print(f"Starting workflow with {args.ncpus} threads")
+    print("Subjects order: {}".format(subjects))
+    # live progress and ETA in <output>/progress/<run>/status.json, and over HTTP with --status_port
+    run = run_name(parser.shard_name())
+    monitor = ProgressMonitor(args.output, progress_plan(node_rows), anatomy, port=args.status_port,
+                              run=run).start()
+    try:
+        if args.scratch:
+            run_staged(args, out_folder, subjects, scrap_directory, run)
+        elif args.parallel_subjects > 1:
+            run_subjects(args, out_folder, subjects, scrap_directory, run)
+        else:
+            wf.run(plugin_args={"status_callback": ProgressRecorder(args.output, run)})
+    finally:
+        monitor.stop()
+    record_node_timings(scrap_directory, args.output, sizes, "_" + parser.shard_name() if parser.is_sharded() else "",
+                        {key: group["units"][0] for key, group in anatomy.items()})
+
+    # before the cleanup, the negative voxel fractions come from the temporary files
+    if args.qc == "after":
+        from modules.qc import run_qc
+
+        run_qc(args.output, subjects, scrap_directory, args.ncpus)
 
     if not args.final_cleanup:
-        args.final_cleanup = continuously_ask_user_yn("Do you want to delete the temporary directory?", True)
+        args.final_cleanup = continuously_ask_user_yn("Do you want to delete the temporary directory?", True,
+                                                      key="final_cleanup")
 
     # if the user selected deletion, then delete the temporary directory
     if args.final_cleanup:
@@ -92,4 +191,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except MissingAnswerError as e:
+        sys.exit(str(e))
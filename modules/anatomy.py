@@ -0,0 +1,133 @@
+import os
+
+from nipype.pipeline.engine import Node, Workflow
+from nipype.interfaces.utility import IdentityInterface, Function
+
+from .data_handler import unit_anatomy, unit_dir, set_units
+from .preprocesses import preprocess_anat_workflow
+from .registration import t2_to_t1_registration
+
+# outputs of the anatomical branch of one pair, used by the units iterated below it
+ANATOMY_FIELDS = ["t1", "t2", "t2_in_t1", "t2_to_t1", "t1_crop", "t2_crop"]
+
+
+def anatomy_key(t1) -> str:
+    # BIDS file names are unique, and the T2w always comes from the folder of the T1w
+    return os.path.basename(t1).split(".")[0]
+
+
+def anatomy_groups(bids_dir, units) -> dict:
+    """
+    The units sharing every anatomical pair, {key: {"t1": ..., "t2": ..., "units": [...]}},
+    in the order of the units. Units without a T1w and a T2w are left out.
+    """
+    groups = {}
+    for unit in units:
+        t1, t2 = unit_anatomy(bids_dir, unit)
+        if t1 is None:
+            continue
+        groups.setdefault(anatomy_key(t1), {"t1": t1, "t2": t2, "units": []})["units"].append(unit)
+    return groups
+
+
+def anatomy_folders(bids_dir, units) -> list:
+    """
+    The folders holding the inputs of the units, relative to the BIDS folder, with the anatomical
+    images they share, e.g. to stage them together.
+    """
+    folders = [unit_dir(unit) for unit in units]
+    for unit in units:
+        for path in unit_anatomy(bids_dir, unit):
+            if path is not None:
+                folders.append(os.path.relpath(os.path.dirname(path), bids_dir))
+    # a folder inside another one is copied with it
+    folders = sorted(set(folders))
+    return [folder for folder in folders
+            if not any(folder.startswith(other + os.sep) for other in folders if other != folder)]
+
+
+def anatomy_file(anat, groups, field):
+    """
+    Connection function giving the T1w or T2w of an anatomical pair, as the one-element list of the BIDS grabber.
+    """
+    return [groups[anat][field]]
+
+
+def unit_file(in_file, subject):
+    """
+    A hard link, or a copy across file systems, of an output of the anatomical branch in the folder of
+    the node. The subject only puts the node in the iteration over the units, so the sink finds the
+    output below the iteration folder of every unit sharing the pair.
+    """
+    import os
+    import shutil
+
+    out_file = os.path.abspath(os.path.basename(in_file))
+    if os.path.lexists(out_file):
+        os.remove(out_file)
+    try:
+        os.link(in_file, out_file)
+    except OSError:
+        shutil.copy2(in_file, out_file)
+    return out_file
+
+
+def unit_file_node(name) -> Node:
+    return Node(Function(input_names=["in_file", "subject"],
+                         output_names=["out_file"],
+                         function=unit_file),
+                name=name)
+
+
+def anatomy_pairs(units, groups) -> list:
+    """
+    The anatomical pairs of the units, in the order of their first unit. Pairs without any of the units
+    are left out, so a subset of the cohort only runs its own pairs.
+    """
+    pairs = {key: group["units"] for key, group in groups.items()}
+    return list(dict.fromkeys(key for unit in units for key, pair_units in pairs.items() if unit in pair_units))
+
+
+def set_unit_order(wf, units, groups) -> None:
+    """
+    Iterate over the anatomical pairs of the workflow in the order of their first unit, and over the units
+    of every pair below it in the given order.
+    """
+    wf.get_node("anatomy.anat_iterator").iterables = ("anat", anatomy_pairs(units, groups))
+    set_units(wf.get_node("subject_iterator"), units, groups)
+
+
+def anatomy_workflow(groups, num_threads=1, crop=False, crop_padding=10.0, retry_dir=None) -> Workflow:
+    """
+    Preprocessing of the T1w and the T2w and the T2w to T1w registration, run once per anatomical pair
+    however many DWI units (sessions) share it. The units are iterated below anat_iterator, see
+    modules.data_handler.set_units, so every unit waits for its own pair only.
+    """
+    if not groups:
+        raise ValueError("no unit has a T1w and a T2w, there is no anatomical pair to process")
+    iterator = Node(IdentityInterface(fields=["anat"]), name="anat_iterator")
+    iterator.iterables = ("anat", list(groups))
+
+    preprocess_anat = preprocess_anat_workflow(num_threads, crop, crop_padding)
+    reg_t2_to_t1 = t2_to_t1_registration(num_threads, retry_dir)
+
+    outputnode = Node(IdentityInterface(fields=["anat"] + ANATOMY_FIELDS), name="outputnode")
+
+    wf = Workflow(name="anatomy")
+    wf.connect([
+        (iterator, preprocess_anat, [(("anat", anatomy_file, groups, "t1"), "inputnode.t1"),
+                                     (("anat", anatomy_file, groups, "t2"), "inputnode.t2")]),
+        (preprocess_anat, reg_t2_to_t1, [("outputnode.t2", "moving_image"),
+                                         ("outputnode.t1", "fixed_image")]),
+
+        (iterator, outputnode, [("anat", "anat")]),
+        (preprocess_anat, outputnode, [("outputnode.t1", "t1"),
+                                       ("outputnode.t2", "t2")]),
+        (reg_t2_to_t1, outputnode, [("warped_image", "t2_in_t1"),
+                                    ("forward_transforms", "t2_to_t1")]),
+    ])
+    if crop:
+        wf.connect(preprocess_anat, "outputnode.t1_crop", outputnode, "t1_crop")
+        wf.connect(preprocess_anat, "outputnode.t2_crop", outputnode, "t2_crop")
+
+    return wf
@@ -0,0 +1,188 @@
+# superior-inferior extent kept below the top of the head, the brain with the cerebellum and some margin
+BRAIN_EXTENT_MM = 180.0
+
+
+def otsu_threshold(values, bins=256) -> float:
+    """
+    Otsu threshold of a set of intensities, e.g. the positive voxels of a head image to separate it from the air.
+    """
+    import numpy as np
+
+    hist, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight = np.cumsum(hist)
+    mean = np.cumsum(hist * centers)
+    between = (mean[-1] * weight / weight[-1] - mean) ** 2 / np.maximum(weight * (weight[-1] - weight), 1)
+    return float(centers[np.argmax(between)])
+
+
+def brain_bounding_box(data, affine, zooms, padding_mm=10.0) -> tuple:
+    """
+    (start, stop) voxel indices per axis of a padded box around the head in a 3D image,
+    cut below the brain along the axis closest to superior-inferior, so the neck is left out.
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    from modules.cropping import otsu_threshold
+
+    data = np.nan_to_num(np.asarray(data, dtype=np.float32))
+    foreground = data[data > 0]
+    if foreground.size == 0:
+        return tuple((0, n) for n in data.shape)
+
+    # Otsu threshold on the positive intensities separates the head from the air
+    mask = data > otsu_threshold(foreground)
+
+    # the largest connected component, noise and ghosts outside of the head don't widen the box
+    mask = ndimage.binary_opening(mask, iterations=2)
+    labels, n = ndimage.label(mask)
+    if n == 0:
+        return tuple((0, n) for n in data.shape)
+    mask = labels == np.argmax(np.bincount(labels.ravel())[1:]) + 1
+
+    box = []
+    nonzero = np.nonzero(mask)
+    for axis in range(3):
+        pad = int(np.ceil(padding_mm / zooms[axis]))
+        box.append([max(int(nonzero[axis].min()) - pad, 0), min(int(nonzero[axis].max()) + 1 + pad, data.shape[axis])])
+
+    # top of the head along the voxel axis closest to world z, then BRAIN_EXTENT_MM down from there
+    si_axis = int(np.argmax(np.abs(affine[2, :3])))
+    extent = int(np.ceil((BRAIN_EXTENT_MM + padding_mm) / zooms[si_axis]))
+    start, stop = box[si_axis]
+    if affine[2, si_axis] > 0:
+        box[si_axis][0] = max(start, stop - extent)
+    else:
+        box[si_axis][1] = min(stop, start + extent)
+    return tuple(tuple(axis) for axis in box)
+
+
+def crop_image(in_file, padding_mm=10.0) -> tuple:
+    """
+    Crop a 3D or 4D NIfTI image to the padded brain bounding box, the box of a 4D image is found on
+    the mean of a few of its volumes. The cropped image keeps the file name and its world coordinates,
+    the crop record <name>_crop.json holds the box and the original grid to restore the outputs.
+    Returns (cropped image, crop record).
+    """
+    import json
+    import os
+
+    import nibabel as nib
+    import numpy as np
+
+    from modules.cropping import brain_bounding_box
+
+    img = nib.load(in_file)
+    if img.ndim > 3:
+        volumes = np.unique(np.linspace(0, img.shape[3] - 1, min(img.shape[3], 5)).astype(int))
+        reference = np.mean([np.asarray(img.dataobj[..., int(v)], dtype=np.float32) for v in volumes], axis=0)
+    else:
+        reference = np.asarray(img.dataobj, dtype=np.float32)
+    box = brain_bounding_box(reference, img.affine, img.header.get_zooms()[:3], padding_mm)
+
+    cropped = img.slicer[tuple(slice(start, stop) for start, stop in box)]
+    name = os.path.basename(in_file)
+    out_file = os.path.abspath(name)
+    cropped.to_filename(out_file)
+
+    stem = name.split(".")[0]
+    record = os.path.abspath(f"{stem}_crop.json")
+    with open(record, "w") as f:
+        json.dump({"source": in_file,
+                   "original_shape": [int(n) for n in img.shape[:3]],
+                   "original_affine": img.affine.tolist(),
+                   "offset": [start for start, _ in box],
+                   "shape": [stop - start for start, stop in box],
+                   "kept_percent": 100.0 * float(np.prod([stop - start for start, stop in box]))
+                                   / float(np.prod(img.shape[:3]))}, f, indent=2)
+    return out_file, record
+
+
+def apply_crop(in_file, crop_record) -> str:
+    """
+    Crop an image on the grid of another one to the box of its crop record, e.g. further runs of a DWI
+    to the box of the first one, so they can be concatenated.
+    """
+    import json
+    import os
+
+    import nibabel as nib
+
+    with open(crop_record) as f:
+        record = json.load(f)
+    img = nib.load(in_file)
+    if list(img.shape[:3]) != record["original_shape"]:
+        raise ValueError(f"{in_file} is not on the grid of {record['source']}")
+    cropped = img.slicer[tuple(slice(o, o + n) for o, n in zip(record["offset"], record["shape"]))]
+    out_file = os.path.abspath(os.path.basename(in_file))
+    cropped.to_filename(out_file)
+    return out_file
+
+
+def crop_runs(first_file, in_files, crop_record) -> list:
+    """
+    All the runs of a DWI on the box of the first one, which is first_file, cropped already when its
+    crop record was made. The others are cropped with apply_crop. Returns the cropped runs in order.
+    """
+    from modules.cropping import apply_crop
+
+    return [first_file] + [apply_crop(in_file, crop_record) for in_file in in_files[1:]]
+
+
+def restore_image(in_file, crop_record, fill=0.0) -> str:
+    """
+    Put an image on a cropped grid back on the original grid of its crop record, fill outside of the box.
+    A displacement field is filled with NaN rather than zero, which would be the identity there, so nothing
+    is silently mapped through it outside of the box. The file name is kept, so the sink substitutions stay the same.
+    """
+    import json
+    import os
+
+    import nibabel as nib
+    import numpy as np
+
+    with open(crop_record) as f:
+        record = json.load(f)
+    img = nib.load(in_file)
+    original_affine = np.array(record["original_affine"])
+
+    # the box of this image on the original grid, from its world position
+    offset = np.linalg.solve(original_affine, img.affine[:, 3])[:3]
+    if not np.allclose(offset, np.round(offset), atol=1e-3):
+        raise ValueError(f"{in_file} is not on the grid of {record['source']}")
+    offset = np.round(offset).astype(int)
+
+    data = np.asarray(img.dataobj)
+    restored = np.full(tuple(record["original_shape"]) + data.shape[3:], fill, dtype=data.dtype)
+    box = tuple(slice(o, o + n) for o, n in zip(offset, data.shape[:3]))
+    restored[box] = data
+
+    header = img.header.copy()
+    out_file = os.path.abspath(os.path.basename(in_file))
+    nib.Nifti1Image(restored, original_affine, header).to_filename(out_file)
+    return out_file
+
+
+def crop_node(name, padding_mm=10.0):
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.utility import Function
+
+    node = Node(Function(input_names=["in_file", "padding_mm"],
+                         output_names=["out_file", "crop_record"],
+                         function=crop_image),
+                name=name)
+    node.inputs.padding_mm = padding_mm
+    return node
+
+
+def restore_node(name, fill=0.0):
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.utility import Function
+
+    node = Node(Function(input_names=["in_file", "crop_record", "fill"],
+                         output_names=["out_file"],
+                         function=restore_image),
+                name=name)
+    node.inputs.fill = fill
+    return node
@@ -1,6 +1,7 @@
 import os.path
 
-from nipype.interfaces.io import BIDSDataGrabber, DataSink
+from nipype.interfaces.base import traits, isdefined
+from nipype.interfaces.io import BIDSDataGrabber, DataSink, DataSinkInputSpec
 from nipype.pipeline.engine import Node, Workflow
 from nipype.interfaces.utility import IdentityInterface, Function
 from nipype.interfaces.mrtrix3.utils import MRConvert
@@ -8,115 +9,433 @@ from nipype.interfaces.mrtrix3.utils import MRConvert
 from .utility_functions import get_single_element
 
 
+BIDS_QUERY = {
+    "T1w": {
+        "datatype": "anat",
+        "suffix": "T1w",
+        "extension": ["nii", "nii.gz"],
+    },
+    "T1_meta": {
+        "datatype": "anat",
+        "suffix": "T1w",
+        "extension": [".json"],
+    },
+    "T2w": {
+        "datatype": "anat",
+        "suffix": "T2w",
+        "extension": ["nii", "nii.gz"],
+    },
+    "T2_meta": {
+        "datatype": "anat",
+        "suffix": "T2w",
+        "extension": [".json"],
+    },
+    "dwi": {
+        "datatype": "dwi",
+        "suffix": "dwi",
+        "extension": ["nii", "nii.gz"],
+    },
+    "dwi_meta": {
+        "datatype": "dwi",
+        "suffix": "dwi",
+        "extension": [".json"],
+    },
+    "bvec": {
+        "datatype": "dwi",
+        "suffix": "dwi",
+        "extension": ["bvec"],
+    },
+    "bval": {
+        "datatype": "dwi",
+        "suffix": "dwi",
+        "extension": ["bval"],
+    },
+}
+
+
+# a unit of work is a subject, or one session of a subject: "<subject>_ses-<session>"
+SESSION_SEPARATOR = "_ses-"
+
+
+def make_unit(subject, session=None) -> str:
+    return f"{subject}{SESSION_SEPARATOR}{session}" if session else subject
+
+
+def split_unit(unit) -> tuple:
+    subject, _, session = unit.partition(SESSION_SEPARATOR)
+    return subject, session or None
+
+
+def unit_dir(unit) -> str:
+    """
+    Folder of the unit below anat/ and dwi/ of the outputs, sub-<subject>[/ses-<session>].
+    """
+    subject, session = split_unit(unit)
+    return os.path.join(f"sub-{subject}", f"ses-{session}") if session else f"sub-{subject}"
+
+
+def unit_label(unit) -> str:
+    return unit_dir(unit).replace(os.sep, "_")
+
+
+def folder_unit(folder) -> str:
+    """
+    The unit of a sub-<subject>[/ses-<session>] folder, or of a nipype iteration folder
+    _subject_<subject> or _session_<session>_subject_<subject>. None for any other folder.
+    """
+    import re
+
+    parts = folder.strip(os.sep).split(os.sep)
+    if parts[0].startswith("sub-"):
+        return make_unit(parts[0][len("sub-"):], parts[1][len("ses-"):] if len(parts) > 1 else None)
+    match = re.fullmatch(r"(?:_session_(\w+?))?_subject_(\w+)", parts[0])
+    if match is None:
+        return None
+    session = match.group(1) if match.group(1) != "None" else None
+    return make_unit(match.group(2), session)
+
+
+def bids_units(layout, subjects) -> list:
+    """
+    One unit per session of every subject, subjects without sessions are a single unit.
+    """
+    return [make_unit(subject, session) for subject in subjects
+            for session in (layout.get_sessions(subject=subject) or [None])]
+
+
+def unit_anatomy(bids_dir, unit) -> tuple:
+    """
+    The (T1w, T2w) pair of a unit: its own, else the one of the subject outside of the sessions,
+    else the one of the first session of the subject with both, so sessions scanned without
+    anatomical images use the anatomy of the subject. (None, None) if the subject has none.
+    """
+    import glob
+
+    subject, session = split_unit(unit)
+    folders = [os.path.join(bids_dir, unit_dir(unit))]
+    if session is not None:
+        folders.append(os.path.join(bids_dir, f"sub-{subject}"))
+        folders += sorted(glob.glob(os.path.join(bids_dir, f"sub-{subject}", "ses-*")))
+    for folder in folders:
+        t1 = sorted(glob.glob(os.path.join(folder, "anat", "*_T1w.nii*")))
+        t2 = sorted(glob.glob(os.path.join(folder, "anat", "*_T2w.nii*")))
+        if t1 and t2:
+            return t1[0], t2[0]
+    return None, None
+
+
+def query_subject_files(layout, unit) -> dict:
+    """
+    The files of one subject, or of one session of it, for every entry of BIDS_QUERY,
+    looked up in an existing BIDSLayout. The anatomical images are those of unit_anatomy.
+    """
+    subject, session = split_unit(unit)
+    # session None matches only the files without a session
+    files = {key: layout.get(subject=subject, session=session, return_type="file", **query)
+             for key, query in BIDS_QUERY.items()}
+    if session is not None and not (files["T1w"] and files["T2w"]):
+        t1, t2 = unit_anatomy(layout.root, unit)
+        if t1 is not None:
+            files["T1w"], files["T2w"] = [t1], [t2]
+    return files
+
+
 def bids_grabber(path) -> Node:
     bg = BIDSDataGrabber()
     bg.inputs.base_dir = path
-    bg.inputs.output_query = {
-        "T1w": {
-            "datatype": "anat",
-            "suffix": "T1w",
-            "extension": ["nii", "nii.gz"],
-        },
-        "T1_meta": {
-            "datatype": "anat",
-            "suffix": "T1w",
-            "extension": [".json"],
-        },
-        "T2w": {
-            "datatype": "anat",
-            "suffix": "T2w",
-            "extension": ["nii", "nii.gz"],
-        },
-        "T2_meta": {
-            "datatype": "anat",
-            "suffix": "T2w",
-            "extension": [".json"],
-        },
-        "dwi": {
-            "datatype": "dwi",
-            "suffix": "dwi",
-            "extension": ["nii", "nii.gz"],
-        },
-        "dwi_meta": {
-            "datatype": "dwi",
-            "suffix": "dwi",
-            "extension": [".json"],
-        },
-        "bvec": {
-            "datatype": "dwi",
-            "suffix": "dwi",
-            "extension": ["bvec"],
-        },
-        "bval": {
-            "datatype": "dwi",
-            "suffix": "dwi",
-            "extension": ["bval"],
-        },
-    }
+    bg.inputs.output_query = BIDS_QUERY
     bg.inputs.raise_on_empty = False
     bg.inputs.unpack_single = True
     bg_node = Node(bg, name="bids_grabber")
     return bg_node
 
 
-def data_source(bids_subjects) -> Node:
-    iterator_node = Node(IdentityInterface(fields=["subject"]),
+def has_sessions(units) -> bool:
+    return any(split_unit(unit)[1] for unit in units)
+
+
+def set_units(iterator_node, units, groups=None) -> None:
+    """
+    Iterate over the units in the given order, over (subject, session) pairs if there are sessions.
+    With the anatomical pairs of modules.anatomy.anatomy_groups, the units of every pair are iterated
+    below the anat_iterator of that pair.
+    """
+    if groups is None:
+        subjects, sessions = zip(*[split_unit(unit) for unit in units]) if units else ((), ())
+        if has_sessions(units):
+            iterator_node.iterables = [("subject", list(subjects)), ("session", list(sessions))]
+            iterator_node.synchronize = True
+        else:
+            iterator_node.iterables = ("subject", list(subjects))
+        return
+
+    # the iterables of an itersource, {pair: values} per field, looked up by the pair of anat_iterator
+    pairs = {key: [split_unit(unit) for unit in units if unit in group["units"]] for key, group in groups.items()}
+    fields = ["subject", "session"] if has_sessions(units) else ["subject"]
+    iterator_node.itersource = ("anat_iterator", "anat")
+    iterator_node.iterables = [(field, {key: [unit[i] for unit in pair] for key, pair in pairs.items() if pair})
+                               for i, field in enumerate(fields)]
+    iterator_node.synchronize = len(fields) > 1
+
+
+def data_source(bids_subjects, groups=None) -> Node:
+    fields = ["subject", "session"] if has_sessions(bids_subjects) else ["subject"]
+    # anat connects the iterator to the anatomical pairs it is iterated below
+    iterator_node = Node(IdentityInterface(fields=fields + ["anat"] if groups is not None else fields),
                          name="subject_iterator")
-    iterator_node.iterables = ("subject", bids_subjects)
+    set_units(iterator_node, bids_subjects, groups)
     iterator_node.inputs.subject = bids_subjects
     return iterator_node
 
 
-def data_sink(out_path, subfolder) -> Node:
+MANIFEST_FILE = "{}_manifest.json"
+
+
+class TransferDataSinkInputSpec(DataSinkInputSpec):
+    transfer_mode = traits.Enum("copy", "link", "move", usedefault=True,
+                                desc="copy the outputs, link them (reflink or hardlink) or move them")
+    manifest = traits.Bool(True, usedefault=True,
+                           desc="hash the outputs while they are transferred and write <subject>_manifest.json")
+    manifest_info = traits.Dict(desc="pipeline parameters and tool versions recorded in the manifest")
+
+
+class TransferDataSink(DataSink):
+    """
+    DataSink which links or moves the outputs to the local output folder instead of copying them
+    when the scratch folder is on the same filesystem, see shared_core.utils.transfer_file.
+    Every output is hashed on its way through, and a manifest with the paths, sizes and sha256 of the
+    outputs of a subject is written next to the subject folders. The folder layout and the substitutions
+    are the ones of DataSink.
+    """
+    input_spec = TransferDataSinkInputSpec
+
+    def _list_outputs(self):
+        if self.inputs.transfer_mode == "copy" and not self.inputs.manifest:
+            return super()._list_outputs()
+
+        import hashlib
+        from nipype.interfaces.io import copytree
+        from nipype.utils.filemanip import ensure_list
+        from shared_core.utils import transfer_file
+
+        outdir = os.path.abspath(self.inputs.base_directory)
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+
+        out_files = []
+        entries = {}
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            subdir = os.path.join(outdir, *[d for d in key.split(".") if d[0] != "@"])
+            files = ensure_list(files)
+            if isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            for src in files:
+                src = os.path.abspath(src)
+                if not os.path.isfile(src):
+                    src = os.path.join(src, "")
+                dst = self._substitute(os.path.join(subdir, self._get_dst(src)))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.isfile(src):
+                    digest = hashlib.sha256() if self.inputs.manifest else None
+                    transfer_file(src, dst, self.inputs.transfer_mode, digest)
+                    if digest is not None:
+                        entries[os.path.relpath(dst, outdir)] = {"size": os.path.getsize(dst),
+                                                                 "sha256": digest.hexdigest()}
+                else:
+                    copytree(src, dst)
+                out_files.append(dst)
+
+        if entries:
+            self._write_manifests(outdir, entries)
+
+        outputs = self.output_spec().get()
+        outputs["out_file"] = out_files
+        return outputs
+
+    def _write_manifests(self, outdir, entries) -> None:
+        import datetime
+        import json
+
+        # one manifest per subject or session folder, <outdir>/<folder>/sub-XX/ses-YY/... belongs to sub-XX_ses-YY
+        by_subject = {}
+        for path, entry in entries.items():
+            labels = [part for part in path.split(os.sep)[:-1] if part.startswith(("sub-", "ses-"))]
+            if labels:
+                by_subject.setdefault("_".join(labels), {})[path] = entry
+
+        info = self.inputs.manifest_info if isdefined(self.inputs.manifest_info) else {}
+        for subject, files in by_subject.items():
+            manifest = {"subject": subject,
+                        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                        "files": dict(sorted(files.items())),
+                        "parameters": info.get("parameters", {}),
+                        "tool_versions": info.get("tool_versions", {})}
+            path = os.path.join(outdir, MANIFEST_FILE.format(subject))
+            with open(path + ".tmp", "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(path + ".tmp", path)
+
+
+def data_sink(out_path, subfolder, transfer_mode="copy", manifest_info=None) -> Node:
     out = os.path.join(out_path, subfolder)
-    ds = Node(DataSink(), name='data_sink')
+    ds = Node(TransferDataSink(), name='data_sink')
     ds.inputs.base_directory = out
+    ds.inputs.transfer_mode = transfer_mode
+    if manifest_info is not None:
+        ds.inputs.manifest_info = manifest_info
     ds.inputs.substitutions = [('_subject_', 'sub-'),
                                ('_session_', 'ses-'),
                                ('warped_t2_to_t1', '_T2w'),
                                ('warped_dwi', '_dwi'),
-                               ('noise_corrected_corrected','')]
+                               ('warped_mean_b0', '_space-T1w_b0'),
+                               ('composite_warp', '_from-dwi_to-T1w_xfm'),
+                               ('_noise_corrected_corrected', '')]
+    # the iteration folder of the anatomical pair the units are iterated below is dropped, the one of a session,
+    # ses-<session>sub-<subject> after the substitutions, becomes
+    # sub-<subject>/ses-<session>, and the one of a subject without sessions in such a dataset sub-<subject>
+    ds.inputs.regexp_substitutions = [(r'/_anat_[^/]+/', '/'),
+                                      (r'/ses-Nonesub-', '/sub-'),
+                                      (r'/ses-([a-zA-Z0-9]+)sub-([a-zA-Z0-9]+)/', r'/sub-\2/ses-\1/'),
+                                      (r'/dwi\.nii\.gz$', '/_desc-preproc_dwi.nii.gz')]
     return ds
 
 
-def extract_pe_rt(meta_path):
-    from nipype.interfaces.io import JSONFileGrabber
-    from modules.utility_functions import get_single_element
+def read_manifest(out_path, unit) -> dict:
+    import json
 
-    meta_path = get_single_element(meta_path)
-    print("Meta path: {}".format(meta_path))
-    jsonSource = JSONFileGrabber()
-    jsonSource.inputs.in_file = meta_path
+    path = os.path.join(out_path, MANIFEST_FILE.format(unit_label(unit)))
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
 
-    # extract needed attributes from json file, phase encoding direction, and total readout time
-    res = (jsonSource.run()).outputs.get()
-    if "PhaseEncodingDirection" in res:
-        phase_encoding_direction = res['PhaseEncodingDirection']
-    else:
-        phase_encoding_direction = "j"
 
-    if "TotalReadoutTime" in res:
-        total_readout_time = float(res['TotalReadoutTime'])
-    else:
-        total_readout_time = 0.145
-    return phase_encoding_direction, total_readout_time
+def expected_outputs(output_mode="resampled") -> list:
+    """
+    (folder, file pattern) of every final output of one subject, after the data_sink substitutions.
+    """
+    dwi = "_dwi.nii.gz" if output_mode == "resampled" else "_desc-preproc_dwi.nii.gz"
+    # the T1 of runs before the N4 suffixes were removed with their underscore is sub-XX_T1w_.nii.gz
+    return [("anat", "*_T1w*.nii*"),
+            ("anat", "_T2w.nii.gz"),
+            ("dwi", dwi),
+            ("dwi", "_space-T1w_b0.nii.gz"),
+            ("dwi", "_from-dwi_to-T1w_xfm.nii.gz"),
+            ("dwi", "grad.bvecs"),
+            ("dwi", "grad.bvals")]
 
 
-def get_meta_parameters() -> Node:
-    get_meta = Node(Function(input_names=["meta_path"],
-                             output_names=["pe", "rt"],
-                             function=extract_pe_rt), name="meta_parameters")
-    return get_meta
+def validate_outputs(out_path, subjects, output_mode="resampled") -> dict:
+    """
+    Missing or empty outputs of every subject (or session), subjects with a complete set of outputs are left out.
+    Outputs whose size differs from the one in the manifest of the subject count as missing. The outputs of
+    a session in the folder earlier versions wrote them to, ses-<session>sub-<subject>, count as well.
+    """
+    import glob
 
+    incomplete = {}
+    for subject in subjects:
+        missing = []
+        subject_label, session = split_unit(subject)
+        folders = [unit_dir(subject)] + ([f"ses-{session}sub-{subject_label}"] if session else [])
+        for folder, pattern in expected_outputs(output_mode):
+            found = [fn for unit_folder in folders
+                     for fn in glob.glob(os.path.join(out_path, folder, unit_folder, pattern))]
+            if not any(os.path.getsize(fn) > 0 for fn in found):
+                missing.append(os.path.join(folder, unit_dir(subject), pattern))
+        for path, entry in read_manifest(out_path, subject).get("files", {}).items():
+            full_path = os.path.join(out_path, path)
+            if not os.path.exists(full_path) or os.path.getsize(full_path) != entry["size"]:
+                missing.append(path)
+        if missing:
+            incomplete[subject] = missing
+    return incomplete
+
+
+def pair_runs(dwi, bvec, bval) -> tuple:
+    """
+    The DWI runs of a subject with their gradient files, paired by file name.
+    Raises ValueError for a run without a bvec or bval of the same name.
+    """
+    import os
+
+    def stem(path):
+        return os.path.basename(path).split(".")[0]
+
+    dwi, bvec, bval = ([files] if isinstance(files, str) else files for files in (dwi, bvec, bval))
+    gradients = {"bvec": {stem(path): path for path in bvec}, "bval": {stem(path): path for path in bval}}
+    dwi = sorted(dwi)
+    for path in dwi:
+        missing = [kind for kind, files in gradients.items() if stem(path) not in files]
+        if missing:
+            raise ValueError(f"{os.path.basename(path)} has no {' and no '.join(missing)} file of the same name")
+    return dwi, [gradients["bvec"][stem(path)] for path in dwi], [gradients["bval"][stem(path)] for path in dwi]
+
+
+def mif_input_combiner(num_threads=1, crop=False, crop_padding=10.0, runs="first") -> Workflow:
+    """
+    The DWI with its gradients as one .mif. With runs "first" only the first run of a subject is used,
+    with "concat" all the runs are converted and concatenated along the volumes (mrcat merges their
+    gradient tables), so the preprocessing runs once on all of them.
+    """
+    from nipype.pipeline.engine import MapNode
+    from .cropping import crop_node, crop_runs
+    from .mrtrix3_extra_interfaces import MRCAT
 
-def mif_input_combiner(num_threads=1) -> Workflow:
     inputnode = Node(IdentityInterface(fields=["dwi", "bvec", "bval"]), name="inputnode")
-    outputnode = Node(IdentityInterface(fields=["dwi"]), name="outputnode")
+    outputnode = Node(IdentityInterface(fields=["dwi", "crop_record"]), name="outputnode")
 
     clean_path_node_dwi = Node(Function(input_names=["in_path"],
                                         output_names=["out_path"],
                                         function=get_single_element),
                                name="clean_path_node_dwi")
+
+    wf = Workflow(name="MIF_combiner")
+    if runs != "concat":
+        wf.connect(inputnode, "dwi", clean_path_node_dwi, "in_path")
+
+    # cropped while it is still a NIfTI, the gradients don't depend on the field of view
+    if crop:
+        crop_dwi = crop_node("crop_dwi", crop_padding)
+        wf.connect(crop_dwi, "crop_record", outputnode, "crop_record")
+
+    if runs == "concat":
+        pair = Node(Function(input_names=["dwi", "bvec", "bval"],
+                             output_names=["dwi", "bvec", "bval"],
+                             function=pair_runs),
+                    name="pair_runs")
+        make_mifs = MapNode(MRConvert(nthreads=num_threads), iterfield=["in_file", "in_bvec", "in_bval"],
+                            name="run_mif_creator")
+        concatenate = Node(MRCAT(axis=3, nthreads=num_threads), name="concatenate_runs")
+
+        wf.connect([
+            (inputnode, pair, [("dwi", "dwi"),
+                               ("bvec", "bvec"),
+                               ("bval", "bval")]),
+            (pair, make_mifs, [("bvec", "in_bvec"),
+                               ("bval", "in_bval")]),
+            (make_mifs, concatenate, [("out_file", "in_files")]),
+            (concatenate, outputnode, [("out_file", "dwi")]),
+        ])
+        if crop:
+            # the box is found on the first run, the others are cropped to it so they stay on the same grid
+            crop_other_runs = Node(Function(input_names=["first_file", "in_files", "crop_record"],
+                                            output_names=["out_files"],
+                                            function=crop_runs),
+                                   name="crop_dwi_runs")
+            wf.connect([
+                (pair, crop_dwi, [(("dwi", get_single_element), "in_file")]),
+                (pair, crop_other_runs, [("dwi", "in_files")]),
+                (crop_dwi, crop_other_runs, [("out_file", "first_file"),
+                                             ("crop_record", "crop_record")]),
+                (crop_other_runs, make_mifs, [("out_files", "in_file")]),
+            ])
+        else:
+            wf.connect(pair, "dwi", make_mifs, "in_file")
+        return wf
+
     clean_path_node_bvec = Node(Function(input_names=["in_path"],
                                          output_names=["out_path"],
                                          function=get_single_element),
@@ -128,17 +447,21 @@ def mif_input_combiner(num_threads=1) -> Workflow:
 
     make_mif = Node(MRConvert(nthreads=num_threads), name="combined_mif_creator")
 
-    wf = Workflow(name="MIF_combiner")
     wf.connect([
-        (inputnode, clean_path_node_dwi, [("dwi", "in_path")]),
         (inputnode, clean_path_node_bvec, [("bvec", "in_path")]),
         (inputnode, clean_path_node_bval, [("bval", "in_path")]),
 
-        (clean_path_node_dwi, make_mif, [("out_path", "in_file")]),
         (clean_path_node_bvec, make_mif, [("out_path", "in_bvec")]),
         (clean_path_node_bval, make_mif, [("out_path", "in_bval")]),
 
         (make_mif, outputnode, [("out_file", "dwi")]),
     ])
+    if crop:
+        wf.connect([
+            (clean_path_node_dwi, crop_dwi, [("out_path", "in_file")]),
+            (crop_dwi, make_mif, [("out_file", "in_file")]),
+        ])
+    else:
+        wf.connect(clean_path_node_dwi, "out_path", make_mif, "in_file")
 
     return wf
@@ -0,0 +1,86 @@
+import glob
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .data_handler import unit_dir
+
+# sidecar fields the pipeline uses and the values assumed when they are missing
+SIDECAR_FIELDS = {"PhaseEncodingDirection": "j",
+                  "TotalReadoutTime": 0.145}
+
+CACHE_FILE = "sidecars.json"
+
+
+def read_sidecar(path) -> dict:
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+    except Exception as e:
+        return {"error": str(e)}
+    return {field: meta.get(field) for field in SIDECAR_FIELDS}
+
+
+def dwi_sidecars(bids_dir, subjects) -> list:
+    # the sidecars of a subject, or of one of its sessions
+    return sorted({path for subject in subjects
+                   for path in glob.glob(os.path.join(bids_dir, unit_dir(subject), "**", "dwi", "*_dwi.json"),
+                                         recursive=True)})
+
+
+def sidecar_table(bids_dir, subjects, cache_dir=None, num_threads=1) -> dict:
+    """
+    The fields of SIDECAR_FIELDS from the DWI sidecars of all the subjects, keyed by file name
+    (unique in BIDS, and the same in staged copies and views of the dataset). The table is cached in
+    <cache_dir>/sidecars.json and only sidecars with a new size or modification time are parsed,
+    in parallel. A missing field is None.
+    """
+    cache_path = os.path.join(cache_dir, CACHE_FILE) if cache_dir else None
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+
+    table, stale = {}, []
+    for path in dwi_sidecars(bids_dir, subjects):
+        st = os.stat(path)
+        name = os.path.basename(path)
+        entry = cache.get(name)
+        if entry is not None and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            table[name] = entry
+        else:
+            stale.append((name, path, st))
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+            parsed = pool.map(read_sidecar, [path for _, path, _ in stale])
+        for (name, _, st), fields in zip(stale, parsed):
+            table[name] = dict(fields, mtime=st.st_mtime, size=st.st_size)
+
+        if cache_path:
+            cache.update(table)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{cache_path}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, cache_path)
+    return table
+
+
+def sidecar_value(meta_path, field):
+    """
+    Connection function feeding one field of the DWI sidecar of a unit to a node, the value of
+    SIDECAR_FIELDS when the field or the sidecar is missing. Only the sidecar of the unit is read,
+    so a node holds and hashes the values of its own unit, and no other sidecar is in its inputs.
+    """
+    from modules.metadata import SIDECAR_FIELDS, read_sidecar
+
+    if isinstance(meta_path, list):
+        meta_path = meta_path[0] if meta_path else None
+    value = read_sidecar(meta_path).get(field) if meta_path else None
+    if value is None:
+        value = SIDECAR_FIELDS[field]
+    return float(value) if field == "TotalReadoutTime" else value
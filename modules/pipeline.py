@@ -0,0 +1,296 @@
+from nipype.pipeline.engine import Workflow
+
+from shared_core.tools import tool_versions
+
+from .anatomy import anatomy_groups, anatomy_folders, anatomy_workflow, unit_file_node
+from .cropping import restore_node
+from .data_handler import (data_source, bids_grabber, data_sink, mif_input_combiner, has_sessions,
+                           split_unit, folder_unit)
+from .metadata import sidecar_table, sidecar_value
+from .preprocesses import preprocess_dwi_workflow
+from .progress import ProgressRecorder
+from .registration import registration_workflow
+from .retry import RETRY_DIR
+
+
+# arguments which change the content of the outputs, recorded in the manifest of every subject
+OUTPUT_PARAMETERS = ["output_mode", "output_grid", "output_spacing", "crop", "crop_padding", "eddy_tier",
+                     "dwi_runs"]
+
+
+def build_workflow(args, bids_dir, subjects, scrap_directory, num_threads=None, anatomy=None) -> Workflow:
+    import os
+
+    num_threads = num_threads or args.ncpus
+    if anatomy is None:
+        anatomy = anatomy_groups(bids_dir, subjects)
+
+    # IO nodes
+    source_iterator = data_source(subjects, anatomy)
+    bids_source = bids_grabber(bids_dir)
+    manifest_info = {"parameters": {name: getattr(args, name) for name in OUTPUT_PARAMETERS},
+                     "tool_versions": tool_versions()}
+    sink = data_sink(bids_dir, args.output, args.sink_mode, manifest_info)
+
+    # define main processing modules (workflows)
+    crop = args.crop != "off"
+    # nodes which ran out of memory are retried with fewer resources, and start that way in later runs
+    retry_dir = os.path.join(args.output, RETRY_DIR)
+    combine_dwi = mif_input_combiner(num_threads, crop, args.crop_padding, args.dwi_runs)
+    preprocess_dwi = preprocess_dwi_workflow(num_threads, args.eddy_tier, retry_dir)
+    # the anatomical branch runs once per T1w/T2w pair, the units sharing a pair are iterated below it
+    preprocess_anat = anatomy_workflow(anatomy, num_threads, crop, args.crop_padding, retry_dir)
+    resample_dwi = args.output_mode == "resampled"
+    registration = registration_workflow(num_threads, args.dwi_chunk_size, args.resample_memory_gb, resample_dwi,
+                                         args.output_grid, args.output_spacing, retry_dir)
+
+    wf = Workflow(name="pipeline_registration", base_dir=scrap_directory)
+    if args.debug:
+        wf.config['execution'] = {'stop_on_first_crash': 'True'}
+
+    # define the workflow with the modules and correctly define interconnections
+    if has_sessions(subjects):
+        wf.connect(source_iterator, "session", bids_source, "session")
+    wf.connect([
+        # the units are iterated below their pair, straight from the pair iterator so that only the
+        # registration and the sink wait for the anatomical branch, the DWI branch starts right away
+        (preprocess_anat, source_iterator, [("anat_iterator.anat", "anat")]),
+        (source_iterator, bids_source, [("subject", "subject")]),
+        (bids_source, combine_dwi, [("dwi", "inputnode.dwi"),
+                                    ("bvec", "inputnode.bvec"),
+                                    ("bval", "inputnode.bval")]),
+        (combine_dwi, preprocess_dwi, [("outputnode.dwi", "inputnode.dwi")]),
+        # phase encoding and readout time straight from the sidecar of the unit, no node per subject
+        (bids_source, preprocess_dwi, [(("dwi_meta", sidecar_value, "PhaseEncodingDirection"), "inputnode.pe"),
+                                       (("dwi_meta", sidecar_value, "TotalReadoutTime"), "inputnode.rt")]),
+
+        (preprocess_dwi, registration, [("outputnode.mean_b0", "inputnode.mean_b0"),
+                                        ("outputnode.dwi_nifti", "inputnode.dwi_nifti")]),
+        (preprocess_anat, registration, [("outputnode.t1", "inputnode.t1"),
+                                         ("outputnode.t2", "inputnode.t2"),
+                                         ("outputnode.t2_to_t1", "inputnode.t2_to_t1")]),
+
+        (preprocess_dwi, sink, [("outputnode.bvec", "dwi.@dwi_bvec"),
+                                ("outputnode.bval", "dwi.@dwi_bval")])
+    ])
+
+    # the images for the sink, in T1 space unless only the transforms are written
+    outputs = [(preprocess_anat, "outputnode.t1", "anat.@t1", "t1"),
+               (preprocess_anat, "outputnode.t2_in_t1", "anat.@t2", "t1"),
+               (registration, "outputnode.mean_b0", "dwi.@mean_b0", "t1"),
+               (registration, "outputnode.composite_warp", "dwi.@composite_warp", "t1")]
+    if resample_dwi:
+        outputs.append((registration, "outputnode.dwi", "dwi.@dwi", "t1"))
+    else:
+        outputs.append((preprocess_dwi, "outputnode.dwi_nifti", "dwi.@dwi_native", "dwi"))
+
+    # cropped outputs come with the crop records to put them back on the original grid later
+    if args.crop == "declared":
+        outputs += [(preprocess_anat, "outputnode.t1_crop", "anat.@t1_crop", None),
+                    (preprocess_anat, "outputnode.t2_crop", "anat.@t2_crop", None),
+                    (combine_dwi, "outputnode.crop_record", "dwi.@dwi_crop", None)]
+
+    crop_records = {"t1": (preprocess_anat, "outputnode.t1_crop"), "dwi": (combine_dwi, "outputnode.crop_record")}
+    for node, field, destination, space in outputs:
+        if args.crop == "restore":
+            # back on the full grid of the image the output is in, zero outside of the crop box, and NaN for
+            # the displacement field, which would map the points outside of the box by the identity otherwise
+            fill = float("nan") if destination == "dwi.@composite_warp" else 0.0
+            restore = restore_node(f"restore_{destination.split('@')[1]}", fill)
+            wf.connect([(node, restore, [(field, "in_file")]),
+                        (crop_records[space][0], restore, [(crop_records[space][1], "crop_record")])])
+            node, field = restore, "out_file"
+        if destination.startswith("anat."):
+            # shared by the units of the pair, linked into the folder of every unit so it is sunk below it
+            link = unit_file_node(f"unit_{destination.split('@')[1]}")
+            wf.connect([(node, link, [(field, "in_file")]),
+                        (source_iterator, link, [("subject", "subject")])])
+            node, field = link, "out_file"
+        wf.connect(node, field, sink, destination)
+
+    return wf
+
+
+def run_units(args, bids_dir, units, scrap_directory, num_threads, run=None) -> list:
+    wf = build_workflow(args, bids_dir, units, scrap_directory, num_threads)
+    wf.run(plugin_args={"status_callback": ProgressRecorder(args.output, run)})
+    return units
+
+
+def unit_groups(bids_dir, units) -> list:
+    """
+    The units in groups sharing an anatomical pair, which are processed together so the anatomical
+    branch runs once for all of them. Units without a pair are groups of their own.
+    """
+    grouped = [group["units"] for group in anatomy_groups(bids_dir, units).values()]
+    found = {unit for group in grouped for unit in group}
+    return grouped + [[unit] for unit in units if unit not in found]
+
+
+def run_subjects(args, bids_dir, subjects, scrap_directory, run=None) -> None:
+    """
+    Run the subjects in the given order in args.parallel_subjects worker processes,
+    every worker starts the next subject as soon as its previous one has finished.
+    Sessions sharing their anatomical images go to the same worker. The workers record
+    their progress as part of the run, see modules.progress.run_name.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    num_threads = max(1, args.ncpus // args.parallel_subjects)
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.parallel_subjects) as pool:
+        futures = {pool.submit(run_units, args, bids_dir, units, scrap_directory, num_threads, run): units
+                   for units in unit_groups(bids_dir, subjects)}
+        for future in as_completed(futures):
+            try:
+                print(f"Finished subjects {future.result()}")
+            except Exception as e:
+                print(f"Subjects {futures[future]} failed: {e}")
+                failed.extend(futures[future])
+
+    if failed:
+        raise RuntimeError(f"Processing failed for subjects: {failed}")
+
+
+def run_staged(args, bids_dir, subjects, scrap_directory, run=None) -> None:
+    """
+    Run the subjects one after another on node-local scratch. The inputs of the next subject are
+    copied in while the current one is processed, and only the sink writes back to the shared folder.
+    Sessions sharing their anatomical images are staged and processed together.
+    """
+    import os
+
+    from shared_core.staging import SubjectStager
+
+    groups = {units[0]: units for units in unit_groups(bids_dir, subjects)}
+    labels = list(groups)
+    stager = SubjectStager(bids_dir, os.path.join(scrap_directory, "inputs"),
+                           lambda label: anatomy_folders(bids_dir, groups[label]))
+    failed = []
+    for index, label in enumerate(labels):
+        staged = stager.get(label)
+        if index + 1 < len(labels):
+            stager.prefetch(labels[index + 1])
+        try:
+            run_units(args, staged, groups[label], scrap_directory, args.ncpus, run)
+        except Exception as e:
+            print(f"Subjects {groups[label]} failed: {e}")
+            failed.extend(groups[label])
+        else:
+            print(f"Finished subjects {groups[label]}")
+        stager.release(label)
+    stager.close()
+
+    if failed:
+        raise RuntimeError(f"Processing failed for subjects: {failed}")
+
+
+def run_worker(args, queue, poll_seconds=30) -> None:
+    """
+    Claim subjects from the work queue and process them until the queue is drained,
+    while other workers still hold leases wait for them to finish or expire.
+    Every item holds the units sharing one anatomical pair.
+    """
+    import os
+    import time
+
+    from shared_core.staging import SubjectStager
+    from shared_core.work_queue import LeaseKeeper
+
+    print(f"Worker {queue.worker_id} started")
+    while True:
+        item = queue.claim()
+        if item is None:
+            if not queue.has_claimed():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        units = item["units"]
+        print(f"Worker {queue.worker_id} processing subjects {units}")
+        with LeaseKeeper(queue, item):
+            try:
+                if args.scratch:
+                    # this host's own scratch instead of the one of the coordinator
+                    scrap_directory = os.path.join(args.scratch, "scrap")
+                    stager = SubjectStager(item["bids_dir"], os.path.join(scrap_directory, "inputs"),
+                                           lambda label: anatomy_folders(item["bids_dir"], units))
+                    try:
+                        run_units(args, stager.get(item["id"]), units, scrap_directory, args.ncpus)
+                    finally:
+                        # a failed item doesn't leave its inputs on the scratch of this host
+                        stager.release(item["id"])
+                        stager.close()
+                else:
+                    run_units(args, item["bids_dir"], units, item["scrap_directory"], args.ncpus)
+            except Exception as e:
+                print(f"Subjects {units} failed: {e}")
+                try:
+                    queue.fail(item, e)
+                except FileNotFoundError:
+                    pass
+                continue
+        try:
+            queue.complete(item)
+        except FileNotFoundError:
+            # the lease expired meanwhile, the item is queued again and its outputs get rewritten
+            pass
+
+    print(f"Worker {queue.worker_id} finished, queue status: {queue.status()}")
+
+
+def subject_view(bids_dir, unit, view_root) -> str:
+    """
+    A BIDS dataset holding only one subject (linked, not copied), so the BIDS grabber
+    indexes a single subject instead of the whole dataset. All sessions of a subject share the view,
+    so a session arriving later finds the anatomical branch of the earlier ones in the nipype cache.
+    """
+    import os
+    import shutil
+
+    subject, _ = split_unit(unit)
+    view = os.path.join(view_root, f"sub-{subject}")
+    os.makedirs(view, exist_ok=True)
+    shutil.copy(os.path.join(bids_dir, "dataset_description.json"), view)
+    link = os.path.join(view, f"sub-{subject}")
+    if not os.path.islink(link):
+        os.symlink(os.path.join(bids_dir, f"sub-{subject}"), link)
+    return view
+
+
+def watch(args, bids_dir, scrap_directory, done_subjects=()) -> None:
+    """
+    Keep processing subjects as their folders appear in the input directory, in this already
+    initialised process, until interrupted.
+    """
+    import os
+    import time
+
+    from bids import BIDSLayout
+    from shared_core.watcher import FolderWatcher
+    from .preflight import preflight, report_preflight
+
+    watcher = FolderWatcher(bids_dir, args.settle_seconds)
+    # the watcher's folders sub-XX[/ses-YY] are the units of the workflow
+    watcher.mark_processed([folder for folder in watcher.units() if folder_unit(folder) in done_subjects])
+    print(f"Watching {bids_dir} for new subjects every {args.poll_seconds} s, press Ctrl+C to stop")
+    try:
+        while True:
+            subjects = [folder_unit(folder) for folder in watcher.poll()]
+            for subject in subjects:
+                print(f"Processing subject {subject}")
+                view = subject_view(bids_dir, subject, os.path.join(scrap_directory, "views"))
+                if args.preflight != "off":
+                    metadata = sidecar_table(view, [subject], args.output)
+                    if not report_preflight(preflight(BIDSLayout(view), [subject], metadata, dwi_runs=args.dwi_runs)):
+                        continue
+                try:
+                    run_units(args, view, [subject], scrap_directory, args.ncpus)
+                except Exception as e:
+                    # picked up again once the files of the subject change
+                    print(f"Subject {subject} failed: {e}")
+                else:
+                    print(f"Finished subject {subject}")
+            time.sleep(args.poll_seconds)
+    except KeyboardInterrupt:
+        print("Stopped watching")
@@ -0,0 +1,339 @@
+import json
+import os
+import statistics
+
+import nibabel as nib
+import numpy as np
+
+from .data_handler import query_subject_files, folder_unit, make_unit
+from .resampling import reference_grid_geometry
+
+
+# node name: (image the cost scales with, seconds per million voxels, memory bytes per voxel, scratch bytes per voxel)
+# rough figures for a CPU workstation, replaced by the calibration from node_timings.json once it exists
+NODE_COSTS = {
+    "bids_grabber": (None, 5.0, 0, 0),
+    "reference_grid": (None, 1.0, 0, 0),
+    "crop_dwi": ("dwi", 0.3, 8, 2),
+    "crop_t1": ("t1", 0.5, 8, 2),
+    "crop_t2": ("t2", 0.5, 8, 2),
+    "combined_mif_creator": ("dwi", 0.2, 4, 4),
+    "crop_dwi_runs": ("dwi", 0.3, 8, 2),
+    "run_mif_creator": ("dwi", 0.2, 4, 4),
+    "concatenate_runs": ("dwi", 0.2, 4, 4),
+    "denoising": ("dwi", 2.0, 12, 4),
+    "zero_clipper_denoising": ("dwi", 0.1, 8, 4),
+    "unringing": ("dwi", 0.6, 8, 4),
+    "zero_clipper_degibbs": ("dwi", 0.1, 8, 4),
+    "EddyCorrect": ("dwi", 37.0, 16, 12),
+    "BiasCorr": ("dwi", 0.6, 8, 4),
+    "extract_b0": ("dwi", 0.1, 4, 1),
+    "mean_b0": ("dwi_volume", 1.0, 8, 4),
+    "convert_mean_b0": ("dwi_volume", 1.0, 8, 2),
+    "convert_dwi": ("dwi", 0.2, 4, 2),
+    "denoising_t1": ("t1", 26.0, 40, 4),
+    "denoising_t2": ("t2", 26.0, 40, 4),
+    "n4_t1": ("t1", 16.0, 40, 4),
+    "n4_t2": ("t2", 16.0, 40, 4),
+    "b0_to_T2": ("t2", 50.0, 150, 20),
+    "T2_to_T1": ("t1", 100.0, 200, 20),
+    "compose_transforms": ("out_volume", 1.0, 40, 12),
+    "apply_transforms": ("out", 0.5, 8, 2),
+    "apply_transforms_b0": ("out_volume", 0.5, 8, 2),
+    "restore_dwi": ("out", 0.3, 8, 2),
+    "restore_dwi_native": ("dwi", 0.3, 8, 2),
+    "restore_mean_b0": ("out_volume", 0.3, 8, 2),
+    "restore_composite_warp": ("out_volume", 1.0, 24, 12),
+    "restore_t1": ("t1", 0.3, 8, 2),
+    "restore_t2": ("t1", 0.3, 8, 2),
+    "data_sink": ("out", 0.05, 0, 0),
+}
+DEFAULT_COST = (None, 0.5, 0, 0)
+NODE_BASE_MEMORY = 0.2 * 1024 ** 3
+
+TIMINGS_FILE = "node_timings{}.json"
+
+
+def image_sizes(files, output_grid="t1", output_spacing=None, dwi_runs="first") -> dict:
+    """
+    Voxel counts the node costs scale with, from the NIfTI headers of one subject only.
+    With dwi_runs "concat" the volumes of all the DWI runs count.
+    """
+    sizes = {"dwi_shape": (), "dwi_zooms": (), "n_volumes": 0,
+             "dwi": 0, "dwi_volume": 0, "t1": 0, "t2": 0, "out": 0, "out_volume": 0}
+    headers = {}
+    for key in ("dwi", "T1w", "T2w"):
+        found = files.get(key) or []
+        found = [found] if isinstance(found, str) else found
+        if found:
+            headers[key] = nib.load(found[0])
+
+    if "dwi" in headers:
+        shape = headers["dwi"].shape
+        sizes["dwi_shape"] = tuple(int(n) for n in shape[:3])
+        sizes["dwi_zooms"] = tuple(round(float(z), 3) for z in headers["dwi"].header.get_zooms()[:3])
+        sizes["n_volumes"] = int(shape[3]) if len(shape) > 3 else 1
+        runs = files.get("dwi") or []
+        if dwi_runs == "concat" and not isinstance(runs, str) and len(runs) > 1:
+            sizes["n_volumes"] = sum(int(np.prod(nib.load(run).shape[3:])) for run in runs)
+        sizes["dwi_volume"] = int(np.prod(shape[:3]))
+        sizes["dwi"] = sizes["dwi_volume"] * sizes["n_volumes"]
+    for key, name in (("T1w", "t1"), ("T2w", "t2")):
+        if key in headers:
+            sizes[name] = int(np.prod(headers[key].shape[:3]))
+
+    if "T1w" in headers:
+        t1 = headers["T1w"]
+        out_shape, _ = reference_grid_geometry(t1.affine, t1.shape, t1.header.get_zooms(),
+                                               sizes["dwi_zooms"] or t1.header.get_zooms(),
+                                               output_grid, output_spacing)
+        sizes["out_volume"] = int(np.prod(out_shape))
+        sizes["out"] = sizes["out_volume"] * max(sizes["n_volumes"], 1)
+    return sizes
+
+
+def subject_sizes(layout, subjects, args) -> dict:
+    return {subject: image_sizes(query_subject_files(layout, subject), args.output_grid, args.output_spacing,
+                                 args.dwi_runs)
+            for subject in subjects}
+
+
+class CostModel:
+    """
+    Per-node wall time, memory and scratch space as a linear function of the voxel count of one image.
+    """
+
+    def __init__(self, timings=None) -> None:
+        self.costs = dict(NODE_COSTS)
+        self.calibrated = set()
+        if timings:
+            self.calibrate(timings)
+
+    def calibrate(self, timings) -> None:
+        by_node = {}
+        for record in timings:
+            by_node.setdefault(record["node"], []).append(record)
+
+        for node, records in by_node.items():
+            driver, seconds, memory, scratch = self.costs.get(node, DEFAULT_COST)
+            units = [self._units(driver, record["sizes"]) for record in records]
+            seconds = statistics.median(r["duration"] / u for r, u in zip(records, units))
+            measured = [(r["mem_peak_gb"], u) for r, u in zip(records, units) if r.get("mem_peak_gb")]
+            if measured:
+                memory = statistics.median(max(m * 1024 ** 3 - NODE_BASE_MEMORY, 0) / (u * 1e6) for m, u in measured)
+            scratch = statistics.median(r["scratch_bytes"] / (u * 1e6) for r, u in zip(records, units))
+            self.costs[node] = (driver, seconds, memory, scratch)
+            self.calibrated.add(node)
+
+    @staticmethod
+    def _units(driver, sizes) -> float:
+        # millions of voxels of the driving image, a node without one costs a flat amount
+        if driver is None:
+            return 1.0
+        return max(sizes.get(driver, 0), 1) / 1e6
+
+    def estimate(self, node, sizes) -> tuple:
+        driver, seconds, memory, scratch = self.costs.get(node, DEFAULT_COST)
+        units = self._units(driver, sizes)
+        return seconds * units, NODE_BASE_MEMORY + memory * units * 1e6, scratch * units * 1e6
+
+
+def load_node_timings(out_dir) -> list:
+    # node_timings.json and the node_timings_<shard>.json files of sharded runs
+    import glob
+
+    timings = []
+    for path in sorted(glob.glob(os.path.join(out_dir, TIMINGS_FILE.format("*")))):
+        with open(path) as f:
+            timings.extend(json.load(f))
+    return timings
+
+
+def path_unit(path, anatomy=None):
+    """
+    The unit a node directory belongs to, from its iteration folder. The units are iterated below their
+    anatomical pair, the directories of the pair only belong to the unit given for it in anatomy,
+    {key: unit}, None without one.
+    """
+    parts = path.split(os.sep)
+    for part in parts:
+        if "_subject_" in part:
+            return folder_unit(part)
+    for part in parts:
+        if part.startswith("_anat_"):
+            return (anatomy or {}).get(part[len("_anat_"):])
+    return None
+
+
+def node_unit(path):
+    """
+    The unit a node directory is recorded for across runs, e.g. by the retries: that of its iteration folder,
+    and for the anatomical branch the unit of the folder its T1w comes from (the pair is named after the T1w,
+    sub-<subject>[_ses-<session>]_..._T1w), whichever units share the pair in this run.
+    """
+    unit = path_unit(path)
+    if unit is not None:
+        return unit
+    for part in path.split(os.sep):
+        if part.startswith("_anat_"):
+            entities = dict(entity.split("-", 1) for entity in part[len("_anat_"):].split("_") if "-" in entity)
+            if "sub" in entities:
+                return make_unit(entities["sub"], entities.get("ses"))
+    return None
+
+
+def record_node_timings(scrap_directory, out_dir, sizes, suffix="", anatomy=None) -> list:
+    """
+    Collect the runtime of every finished node from the nipype result files of the last run
+    and append them, with the image sizes of their subject, to node_timings<suffix>.json in the output folder.
+    The nodes of the anatomical branch count for the first subject of their pair in anatomy, {key: subject}.
+    """
+    from nipype.utils.filemanip import loadpkl
+
+    records = []
+    for root, _, files in os.walk(scrap_directory):
+        subject = path_unit(root, anatomy)
+        if subject not in sizes:
+            continue
+        for fn in files:
+            if not (fn.startswith("result_") and fn.endswith(".pklz")):
+                continue
+            try:
+                runtime = loadpkl(os.path.join(root, fn)).runtime
+            except Exception:
+                continue
+            duration = getattr(runtime, "duration", None)
+            if duration is None:
+                continue
+            scratch = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(root) for f in fs)
+            records.append({"node": fn[len("result_"):-len(".pklz")],
+                            "subject": subject,
+                            "duration": float(duration),
+                            "mem_peak_gb": getattr(runtime, "mem_peak_gb", None),
+                            "scratch_bytes": scratch,
+                            "sizes": sizes[subject]})
+
+    path = os.path.join(out_dir, TIMINGS_FILE.format(suffix))
+    timings = []
+    if os.path.exists(path):
+        with open(path) as f:
+            timings = json.load(f)
+    timings += records
+    os.makedirs(out_dir, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(timings, f)
+    print(f"Recorded {len(records)} node timings in {path}")
+    return timings
+
+
+def workflow_nodes(wf) -> tuple:
+    """
+    Nodes and dependencies of one iteration of the workflow, the graph is built but not executed.
+    Returns ({full node name: node name}, [(full name, full name)]), identity nodes map to None.
+    """
+    from nipype.interfaces.utility import IdentityInterface
+
+    graph = wf._create_flat_graph()
+    nodes = {node.fullname: None if isinstance(node.interface, IdentityInterface) else node.name
+             for node in graph.nodes()}
+    edges = [(u.fullname, v.fullname) for u, v in graph.edges()]
+    return nodes, edges
+
+
+def _critical_path(nodes, edges, seconds) -> float:
+    # longest chain of dependent nodes, the wall time of one subject given enough threads
+    parents = {node: [] for node in nodes}
+    for u, v in edges:
+        parents[v].append(u)
+    finish = {}
+
+    def finish_time(node):
+        if node not in finish:
+            finish[node] = seconds[node] + max((finish_time(p) for p in parents[node]), default=0.0)
+        return finish[node]
+
+    return max((finish_time(node) for node in nodes), default=0.0)
+
+
+def plan_cohort(wf, sizes, model, anatomy=None) -> tuple:
+    """
+    Estimate per node and per subject costs. Returns (subject rows, node rows).
+    The anatomical branch of a pair shared by several units, see modules.anatomy.anatomy_groups,
+    runs once and is charged to the first of its units, as in record_node_timings.
+    """
+    nodes, edges = workflow_nodes(wf)
+    shared = {unit for group in (anatomy or {}).values() for unit in group["units"][1:]}
+    subject_rows, node_rows = [], []
+    for subject, subject_size in sizes.items():
+        seconds, peak_memory, scratch = dict.fromkeys(nodes, 0.0), 0.0, 0.0
+        for fullname, name in nodes.items():
+            if name is None or subject in shared and ".anatomy." in fullname:
+                continue
+            node_seconds, node_memory, node_scratch = model.estimate(name, subject_size)
+            seconds[fullname] = node_seconds
+            peak_memory = max(peak_memory, node_memory)
+            scratch += node_scratch
+            node_rows.append({"subject": subject, "node": fullname, "seconds": node_seconds,
+                              "memory_gb": node_memory / 1024 ** 3, "scratch_gb": node_scratch / 1024 ** 3,
+                              "calibrated": name in model.calibrated})
+        subject_rows.append({"subject": subject,
+                             "dwi_shape": "x".join(str(n) for n in subject_size["dwi_shape"]) or "-",
+                             "volumes": subject_size["n_volumes"],
+                             "voxel_mm": "x".join(str(z) for z in subject_size["dwi_zooms"]) or "-",
+                             "wall_hours": _critical_path(nodes, edges, seconds) / 3600,
+                             "node_hours": sum(seconds.values()) / 3600,
+                             "peak_memory_gb": peak_memory / 1024 ** 3,
+                             "scratch_gb": scratch / 1024 ** 3})
+    return subject_rows, node_rows
+
+
+def anatomy_savings(wf, groups, sizes, model) -> list:
+    """
+    Node hours of the anatomical branch of every T1w/T2w pair, which runs once however many
+    units share the pair, and the node hours saved against running it for every unit.
+    """
+    nodes, _ = workflow_nodes(wf)
+    names = [name for fullname, name in nodes.items() if name is not None and ".anatomy." in fullname]
+    rows = []
+    for key, group in groups.items():
+        units = [unit for unit in group["units"] if unit in sizes]
+        if not units:
+            continue
+        seconds = sum(model.estimate(name, sizes[units[0]])[0] for name in names)
+        rows.append({"anatomy": key, "units": len(units), "node_hours": seconds / 3600,
+                     "saved_node_hours": seconds * (len(units) - 1) / 3600})
+    return rows
+
+
+def print_anatomy_savings(rows) -> None:
+    shared = [row for row in rows if row["units"] > 1]
+    print(f"Anatomical preprocessing: {len(rows)} T1w/T2w pairs for {sum(r['units'] for r in rows)} units, "
+          f"{len(shared)} pairs shared, {sum(r['saved_node_hours'] for r in rows):.1f} node-hours saved")
+
+
+def write_table(rows, path) -> None:
+    if not rows:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write("\t".join(rows[0].keys()) + "\n")
+        for row in rows:
+            f.write("\t".join(f"{v:.3f}" if isinstance(v, float) else str(v) for v in row.values()) + "\n")
+
+
+def print_plan(subject_rows, model) -> None:
+    print(f"{'subject':<16}{'dwi shape':<16}{'vols':>6}{'voxel mm':>16}{'wall h':>9}{'node h':>9}"
+          f"{'mem GB':>9}{'scratch GB':>12}")
+    for row in subject_rows:
+        print(f"{row['subject']:<16}{row['dwi_shape']:<16}{row['volumes']:>6}{row['voxel_mm']:>16}"
+              f"{row['wall_hours']:>9.2f}{row['node_hours']:>9.2f}{row['peak_memory_gb']:>9.1f}"
+              f"{row['scratch_gb']:>12.1f}")
+    print(f"Total: {len(subject_rows)} subjects, "
+          f"{sum(r['node_hours'] for r in subject_rows):.1f} node-hours, "
+          f"longest subject {max((r['wall_hours'] for r in subject_rows), default=0):.2f} h, "
+          f"peak memory {max((r['peak_memory_gb'] for r in subject_rows), default=0):.1f} GB, "
+          f"scratch {sum(r['scratch_gb'] for r in subject_rows):.1f} GB")
+    if model.calibrated:
+        print(f"Calibrated from earlier runs: {', '.join(sorted(model.calibrated))}")
+    else:
+        print("No earlier runs found, using the default cost model")
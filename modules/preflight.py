@@ -0,0 +1,152 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from .data_handler import query_subject_files
+from .metadata import SIDECAR_FIELDS
+
+
+def _as_list(files) -> list:
+    if not files:
+        return []
+    return sorted([files] if isinstance(files, str) else files)
+
+
+def _stem(path) -> str:
+    return os.path.basename(path).split(".")[0]
+
+
+def _check_zooms(name, img, errors) -> None:
+    zooms = np.asarray(img.header.get_zooms()[:3], dtype=float)
+    if len(zooms) < 3 or not np.all(np.isfinite(zooms)) or np.any(zooms <= 0):
+        errors.append(f"{name} has invalid voxel sizes {tuple(zooms)}")
+
+
+def _gradient_count(path, kind) -> int:
+    values = np.loadtxt(path, ndmin=2)
+    if kind == "bvec":
+        # 3 rows as in BIDS, or 3 columns as some converters write them
+        if values.shape[0] == 3:
+            return values.shape[1]
+        if values.shape[1] == 3:
+            return values.shape[0]
+        raise ValueError(f"bvec with shape {values.shape}")
+    return values.size
+
+
+def check_subject(files, metadata, dwi_runs="first") -> tuple:
+    """
+    Header-only checks of the inputs of one subject, no image data is read, the sidecars are
+    looked up in the table of modules.metadata.sidecar_table. With dwi_runs "concat" several
+    DWI runs have to share their grid and phase encoding to be concatenated.
+    Returns (errors, warnings), a subject with errors can't be processed.
+    """
+    errors, warnings = [], []
+
+    for key in ("T1w", "T2w"):
+        found = _as_list(files.get(key))
+        if not found:
+            errors.append(f"no {key}")
+        else:
+            # like the pipeline, the first of several images is used
+            if len(found) > 1:
+                warnings.append(f"{len(found)} {key} images, {os.path.basename(found[0])} is used")
+            try:
+                img = nib.load(found[0])
+                if len(img.shape) > 3 and img.shape[3] > 1:
+                    errors.append(f"{key} is 4D with {img.shape[3]} volumes")
+                _check_zooms(key, img, errors)
+            except Exception as e:
+                errors.append(f"{key} can't be read: {e}")
+
+    dwis = _as_list(files.get("dwi"))
+    # the gradients of a run have its file name, as modules.data_handler.pair_runs pairs them
+    gradients = {kind: {_stem(path): path for path in _as_list(files.get(kind))} for kind in ("bval", "bvec")}
+    if not dwis:
+        errors.append("no DWI")
+    else:
+        for dwi in dwis:
+            name = os.path.basename(dwi)
+            missing = [kind for kind in gradients if _stem(dwi) not in gradients[kind]]
+            if missing:
+                errors.append(f"{name} has no {' and no '.join(missing)} file")
+                continue
+            try:
+                img = nib.load(dwi)
+                _check_zooms(name, img, errors)
+                volumes = img.shape[3] if len(img.shape) > 3 else 1
+                if volumes < 2:
+                    errors.append(f"{name} has {volumes} volume")
+                counts = {kind: _gradient_count(gradients[kind][_stem(dwi)], kind) for kind in gradients}
+                for kind, count in counts.items():
+                    if count != volumes:
+                        errors.append(f"{name} has {volumes} volumes but {count} {kind} entries")
+            except Exception as e:
+                errors.append(f"{name} or its gradients can't be read: {e}")
+        if len(dwis) > 1 and dwi_runs == "first":
+            warnings.append(f"{len(dwis)} DWI runs, only the first is processed")
+        elif len(dwis) > 1:
+            try:
+                grids = [nib.load(dwi) for dwi in dwis]
+                if any(img.shape[:3] != grids[0].shape[:3] or not np.allclose(img.affine, grids[0].affine, atol=1e-3)
+                       for img in grids[1:]):
+                    errors.append(f"the {len(dwis)} DWI runs are on different grids and can't be concatenated")
+            except Exception:
+                pass
+
+    sidecars = _as_list(files.get("dwi_meta"))
+    if not sidecars:
+        warnings.append("no DWI sidecar, the phase encoding direction j and readout time 0.145 s are assumed")
+    else:
+        if dwi_runs == "concat" and len(sidecars) > 1:
+            directions = {metadata.get(os.path.basename(sidecar), {}).get("PhaseEncodingDirection")
+                          for sidecar in sidecars}
+            if len(directions) > 1:
+                errors.append(f"the DWI runs have different phase encoding directions {sorted(map(str, directions))}")
+        entry = metadata.get(os.path.basename(sidecars[0]), {})
+        if "error" in entry:
+            errors.append(f"the DWI sidecar can't be read: {entry['error']}")
+        else:
+            for field, default in SIDECAR_FIELDS.items():
+                if entry.get(field) is None:
+                    warnings.append(f"no {field} in the DWI sidecar, {default} is assumed")
+
+    return errors, warnings
+
+
+def preflight(layout, subjects, metadata, num_threads=1, dwi_runs="first") -> dict:
+    """
+    Check all the subjects before the workflow is built, the headers are read in parallel.
+    Returns {subject: (errors, warnings)}.
+    """
+    # the layout is queried from this thread only, only the file reads run in parallel
+    files = {subject: query_subject_files(layout, subject) for subject in subjects}
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+        results = pool.map(check_subject, [files[subject] for subject in subjects], [metadata] * len(subjects),
+                           [dwi_runs] * len(subjects))
+    return dict(zip(subjects, results))
+
+
+def report_preflight(results) -> list:
+    """
+    Print the problems of every subject, returns the subjects which can be processed.
+    """
+    passed = []
+    for subject, (errors, warnings) in results.items():
+        for warning in warnings:
+            print(f"Subject {subject}: warning, {warning}")
+        for error in errors:
+            print(f"Subject {subject}: error, {error}")
+        if not errors:
+            passed.append(subject)
+    excluded = len(results) - len(passed)
+    print(f"Preflight: {len(passed)} of {len(results)} subjects passed"
+          + (f", {excluded} excluded" if excluded else ""))
+    return passed
+
+
+def preflight_rows(results) -> list:
+    return [{"subject": subject, "passed": not errors, "errors": "; ".join(errors) or "-",
+             "warnings": "; ".join(warnings) or "-"} for subject, (errors, warnings) in results.items()]
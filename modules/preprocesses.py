@@ -1,7 +1,36 @@
-def preprocess_dwi_workflow(num_threads=1):
+# eddy options of the correction tiers, from a quick check run to the eddy defaults of the full run;
+# the leading space keeps dwifslpreproc from reading them as its own options
+EDDY_TIERS = {
+    "quick": " --niter=2 --fwhm=10,0 --nvoxhp=500",
+    "reduced": " --niter=4 --fwhm=10,5,0,0 --nvoxhp=1000",
+    "full": "",
+}
+
+
+def eddy_interface(num_threads=1, tier="full", retry_dir=None):
+    """
+    dwifslpreproc with the eddy options of the tier, eddy (OpenMP) runs with num_threads threads.
+    The retries are recorded in retry_dir when given, see modules.retry.
+    """
+    from .retry import RetryDWIPreproc
+
+    # retried with fewer threads when eddy runs out of memory, see modules.retry
+    eddy = RetryDWIPreproc(rpe_options="none",
+                           export_grad_fsl=True,
+                           nthreads=num_threads)
+    if EDDY_TIERS[tier]:
+        eddy.inputs.eddy_options = EDDY_TIERS[tier]
+    if retry_dir:
+        eddy.inputs.retry_dir = retry_dir
+    # dwifslpreproc passes -nthreads to the MRtrix3 commands only, eddy_openmp reads the thread count from here
+    eddy.inputs.environ = {"OMP_NUM_THREADS": str(num_threads)}
+    return eddy
+
+
+def preprocess_dwi_workflow(num_threads=1, eddy_tier="full", retry_dir=None):
     from nipype.interfaces.mrtrix3.preprocess import DWIDenoise, MRDeGibbs
     from nipype.interfaces.mrtrix3 import MRConvert, MRMath, DWIBiasCorrect, DWIExtract
-    from .mrtrix3_extra_interfaces import Threshold, DWIPreprocCustom
+    from .mrtrix3_extra_interfaces import Threshold
     from nipype.pipeline.engine import Node, Workflow
     from nipype.interfaces.utility import IdentityInterface
 
@@ -19,11 +48,8 @@ def preprocess_dwi_workflow(num_threads=1):
     # Gibbs ringing removal
     unringing = Node(MRDeGibbs(nthreads=num_threads), name="unringing")
 
-    # Eddy current correction and motion correction
-    eddy = Node(DWIPreprocCustom(rpe_options="none",
-                                 export_grad_fsl=True,
-                                 nthreads=num_threads),
-                name="EddyCorrect")
+    # Eddy current correction and motion correction, eddy gets all the threads of the subject
+    eddy = Node(eddy_interface(num_threads, eddy_tier, retry_dir), name="EddyCorrect", n_procs=num_threads)
 
     # B1 field inhomogeneity correction
     bias = Node(DWIBiasCorrect(use_ants=True, nthreads=num_threads),
@@ -67,14 +93,15 @@ def preprocess_dwi_workflow(num_threads=1):
     return wf
 
 
-def preprocess_anat_workflow(num_threads=1):
+def preprocess_anat_workflow(num_threads=1, crop=False, crop_padding=10.0):
     from nipype.interfaces.ants import DenoiseImage, N4BiasFieldCorrection
     from nipype.pipeline.engine import Node, Workflow
     from nipype.interfaces.utility import IdentityInterface, Function
     from modules.utility_functions import get_single_element
+    from .cropping import crop_node
 
     inputnode = Node(IdentityInterface(fields=["t1", "t2"]), name="inputnode")
-    outputnode = Node(IdentityInterface(fields=["t1", "t2"]), name="outputnode")
+    outputnode = Node(IdentityInterface(fields=["t1", "t2", "t1_crop", "t2_crop"]), name="outputnode")
 
     clean_path_node_t1 = Node(Function(input_names=["in_path"],
                                        output_names=["out_path"],
@@ -106,14 +133,30 @@ def preprocess_anat_workflow(num_threads=1):
         (inputnode, clean_path_node_t1, [("t1", "in_path")]),
         (inputnode, clean_path_node_t2, [("t2", "in_path")]),
 
-        (clean_path_node_t1, denoise_t1, [("out_path", "input_image")]),
         (denoise_t1, n4_t1, [("output_image", "input_image")]),
-
-        (clean_path_node_t2, denoise_t2, [("out_path", "input_image")]),
         (denoise_t2, n4_t2, [("output_image", "input_image")]),
 
         (n4_t1, outputnode, [("output_image", "t1")]),
         (n4_t2, outputnode, [("output_image", "t2")])
     ])
 
+    # denoising, N4 and the registrations only see the padded head bounding box
+    if crop:
+        crop_t1 = crop_node("crop_t1", crop_padding)
+        crop_t2 = crop_node("crop_t2", crop_padding)
+        wf.connect([
+            (clean_path_node_t1, crop_t1, [("out_path", "in_file")]),
+            (crop_t1, denoise_t1, [("out_file", "input_image")]),
+            (crop_t1, outputnode, [("crop_record", "t1_crop")]),
+
+            (clean_path_node_t2, crop_t2, [("out_path", "in_file")]),
+            (crop_t2, denoise_t2, [("out_file", "input_image")]),
+            (crop_t2, outputnode, [("crop_record", "t2_crop")]),
+        ])
+    else:
+        wf.connect([
+            (clean_path_node_t1, denoise_t1, [("out_path", "input_image")]),
+            (clean_path_node_t2, denoise_t2, [("out_path", "input_image")]),
+        ])
+
     return wf
@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+from .planning import path_unit
+
+PROGRESS_DIR = "progress"
+STATUS_FILE = "status.json"
+EVENT_STATES = {"start": "running", "end": "done", "exception": "failed"}
+
+
+def run_name(shard_name="") -> str:
+    # runs sharing the output folder, shards, workers or another run, keep their progress apart
+    return shard_name or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def events_dir(out_dir, run) -> str:
+    return os.path.join(out_dir, PROGRESS_DIR, run, "events")
+
+
+class ProgressRecorder:
+    """
+    nipype status callback appending the start, end or failure of every node to an events file of this
+    process in <output>/progress/<run>/events, so nodes run by worker processes of the run are seen too.
+    The run is that of this process by default, see run_name.
+    """
+
+    def __init__(self, out_dir, run=None) -> None:
+        self.folder = events_dir(out_dir, run or run_name())
+        self.path = os.path.join(self.folder, f"{socket.gethostname()}-{os.getpid()}.jsonl")
+
+    def __call__(self, node, status) -> None:
+        try:
+            node_dir = node.output_dir()
+        except Exception:
+            node_dir = ""
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"time": time.time(), "node": node.name, "dir": node_dir, "status": status}) + "\n")
+
+
+def progress_plan(node_rows) -> dict:
+    """
+    Estimated seconds of the nodes every unit runs, {unit: {node name: seconds}}, from the node rows of
+    plan_cohort, which has the anatomical branch of a shared pair for the first of its units only.
+    """
+    plan = {}
+    for row in node_rows:
+        plan.setdefault(row["subject"], {})[row["node"].split(".")[-1]] = row["seconds"]
+    return plan
+
+
+class ProgressMonitor:
+    """
+    Refresh <output>/progress/<run>/status.json every interval seconds from the node events of all
+    processes of the run and, given a port, serve it at http://127.0.0.1:<port>/. The ETA is the estimated work of
+    the nodes left, from the cost model calibrated by earlier runs and scaled by the image sizes of
+    every subject, at the rate the run has worked through the estimates so far.
+    """
+
+    def __init__(self, out_dir, plan, anatomy=None, interval=30, port=None, run=None) -> None:
+        self.out_dir = out_dir
+        self.run = run or run_name()
+        self.plan = plan
+        self.anatomy = {key: group["units"][0] for key, group in (anatomy or {}).items()}
+        self.interval = interval
+        self.port = port
+
+        self.status = {}
+        self._states = {}
+        self._offsets = {}
+        self._started = None
+        self._printed = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._server = None
+
+    def _read_events(self) -> None:
+        folder = events_dir(self.out_dir, self.run)
+        if not os.path.isdir(folder):
+            return
+        for fn in sorted(os.listdir(folder)):
+            path = os.path.join(folder, fn)
+            with open(path, "rb") as f:
+                f.seek(self._offsets.get(path, 0))
+                data = f.read()
+            # a line still being written is read again next time
+            complete = data[:data.rfind(b"\n") + 1]
+            self._offsets[path] = self._offsets.get(path, 0) + len(complete)
+            for line in complete.decode().splitlines():
+                event = json.loads(line)
+                unit = path_unit(event["dir"], self.anatomy)
+                if event["node"] in self.plan.get(unit, {}):
+                    self._states[(unit, event["node"])] = EVENT_STATES.get(event["status"], "running")
+
+    def refresh(self) -> dict:
+        self._read_events()
+        now = time.time()
+        units = {"done": 0, "running": 0, "queued": 0, "failed": 0}
+        nodes = {"done": 0, "running": 0, "queued": 0, "failed": 0}
+        done_seconds, left_seconds = 0.0, 0.0
+        for unit, estimates in self.plan.items():
+            states = [self._states.get((unit, node), "queued") for node in estimates]
+            for state in states:
+                nodes[state] += 1
+            if "failed" in states:
+                units["failed"] += 1
+                continue
+            if all(state == "done" for state in states):
+                units["done"] += 1
+            elif any(state != "queued" for state in states):
+                units["running"] += 1
+            else:
+                units["queued"] += 1
+            for node, seconds in estimates.items():
+                if self._states.get((unit, node)) == "done":
+                    done_seconds += seconds
+                else:
+                    left_seconds += seconds
+
+        elapsed = now - self._started
+        # estimated node seconds worked through per wall second, covers the parallelism and the model error
+        rate = done_seconds / elapsed if done_seconds > 0 and elapsed > 0 else None
+        eta = left_seconds / rate if rate else None
+        self.status = {"updated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+                       "elapsed_hours": elapsed / 3600,
+                       "subjects": units,
+                       "nodes": nodes,
+                       "throughput": {"subjects_per_hour": units["done"] / (elapsed / 3600) if elapsed > 0 else 0.0,
+                                      "nodes_per_hour": nodes["done"] / (elapsed / 3600) if elapsed > 0 else 0.0,
+                                      "estimated_node_hours_per_hour": rate},
+                       "estimated_node_hours_left": left_seconds / 3600,
+                       "eta_hours": eta / 3600 if eta is not None else None,
+                       "eta": time.strftime("%Y-%m-%d %H:%M", time.localtime(now + eta)) if eta is not None else None}
+
+        path = os.path.join(self.out_dir, PROGRESS_DIR, self.run, STATUS_FILE)
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self.status, f, indent=2)
+        os.replace(tmp, path)
+
+        summary = (nodes["done"], units["done"], units["failed"])
+        if summary != self._printed:
+            self._printed = summary
+            print(f"Progress: {units['done']}/{len(self.plan)} subjects done, {units['running']} running, "
+                  f"{units['failed']} failed, {nodes['done']}/{sum(nodes.values())} nodes, "
+                  f"ETA {self.status['eta'] or 'after the first nodes finish'}")
+        return self.status
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Progress could not be updated: {e}")
+
+    def _serve(self) -> None:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        monitor = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(monitor.status).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), StatusHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Progress at http://127.0.0.1:{self.port}/")
+
+    def start(self) -> "ProgressMonitor":
+        # events of an earlier run of the same shard don't count, those of the other runs are theirs
+        shutil.rmtree(events_dir(self.out_dir, self.run), ignore_errors=True)
+        os.makedirs(events_dir(self.out_dir, self.run), exist_ok=True)
+        self._started = time.time()
+        self.refresh()
+        if self.port:
+            self._serve()
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.refresh()
+        if self._server is not None:
+            self._server.shutdown()
@@ -0,0 +1,249 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .data_handler import unit_dir
+from .planning import path_unit
+
+# final outputs the metrics are computed from, below anat/ and dwi/ of the outputs, see expected_outputs
+QC_OUTPUTS = {"t1": ("anat", "*_T1w*.nii*"),
+              "t2": ("anat", "_T2w.nii.gz"),
+              "b0": ("dwi", "_space-T1w_b0.nii.gz")}
+# nodes of PreprocessDWI whose outputs still hold the negative values the following Threshold removes
+QC_THRESHOLDED = {"negative_denoising_percent": "denoising",
+                  "negative_degibbs_percent": "unringing"}
+QC_GRID_MM = 4.0
+QC_BINS = 32
+# below this fraction of the T1 brain covered by the warped b0 a unit fails whatever the cohort
+QC_MIN_COVERAGE = 0.9
+# robust z-score of an outlier in the cohort, only with at least QC_MIN_COHORT units
+QC_OUTLIER_Z = 3.5
+QC_MIN_COHORT = 5
+# metrics and the side an outlier is on, low image similarity or many negative voxels
+QC_METRICS = {"nmi_b0_t1": -1, "nmi_t2_t1": -1, "coverage": -1,
+              "negative_denoising_percent": 1, "negative_degibbs_percent": 1}
+QC_FILE = "qc.tsv"
+QC_FAILED_FILE = "qc_failed.txt"
+
+MIF_TYPES = {"Int8": "i1", "UInt8": "u1", "Int16": "i2", "UInt16": "u2", "Int32": "i4", "UInt32": "u4",
+             "Int64": "i8", "UInt64": "u8", "Float32": "f4", "Float64": "f8"}
+
+
+def downsampled(path, grid_mm=QC_GRID_MM) -> tuple:
+    """
+    Every n-th voxel of an image along each axis, about grid_mm apart, and the affine of that grid.
+    Uncompressed images are memory-mapped, so only the voxels kept are read.
+    """
+    import nibabel as nib
+
+    img = nib.load(path)
+    steps = [max(1, int(round(grid_mm / zoom))) for zoom in img.header.get_zooms()[:3]]
+    index = tuple(slice(None, None, step) for step in steps) + (0,) * (len(img.shape) - 3)
+    data = np.nan_to_num(np.asarray(img.dataobj[index], dtype=np.float32))
+    return data, img.affine @ np.diag(steps + [1])
+
+
+def sample(data, affine, points) -> np.ndarray:
+    # nearest neighbour values of an image at world points (N, 3), zero outside of its grid
+    voxels = np.rint(np.c_[points, np.ones(len(points))] @ np.linalg.inv(affine).T)[:, :3].astype(int)
+    inside = np.all((voxels >= 0) & (voxels < data.shape), axis=1)
+    values = np.zeros(len(points), dtype=data.dtype)
+    values[inside] = data[tuple(voxels[inside].T)]
+    return values
+
+
+def grid_points(shape, affine) -> np.ndarray:
+    voxels = np.indices(shape).reshape(3, -1).T
+    return voxels @ affine[:3, :3].T + affine[:3, 3]
+
+
+def head_mask(data) -> np.ndarray:
+    from scipy import ndimage
+
+    from .cropping import otsu_threshold
+
+    foreground = data[data > 0]
+    if foreground.size == 0:
+        return np.zeros(data.shape, dtype=bool)
+    return ndimage.binary_fill_holes(data > otsu_threshold(foreground))
+
+
+def normalized_mutual_information(a, b, bins=QC_BINS) -> float:
+    """
+    (H(a) + H(b)) / H(a, b) of two sets of intensities, 1 for independent and 2 for identical images.
+    """
+    if a.size == 0:
+        return float("nan")
+    joint, _, _ = np.histogram2d(a, b, bins=bins)
+    joint /= joint.sum()
+
+    def entropy(p):
+        p = p[p > 0]
+        return -float(np.sum(p * np.log(p)))
+
+    return (entropy(joint.sum(axis=1)) + entropy(joint.sum(axis=0))) / entropy(joint)
+
+
+def mif_data(path) -> np.ndarray:
+    """
+    The voxels of a MRtrix3 .mif image as a flat memory-mapped array, in the order they are stored.
+    """
+    header = {}
+    with open(path, "rb") as f:
+        if f.readline().strip() != b"mrtrix image":
+            raise ValueError(f"{path} is not a MRtrix3 image")
+        for line in f:
+            line = line.decode().strip()
+            if line == "END":
+                break
+            key, _, value = line.partition(":")
+            header[key.strip()] = value.strip()
+
+    datatype = header["datatype"]
+    order = ">" if datatype.endswith("BE") else "<"
+    dtype = np.dtype(order + MIF_TYPES[datatype[:-2] if datatype.endswith(("LE", "BE")) else datatype])
+    data_file, _, offset = header["file"].partition(" ")
+    if data_file != ".":
+        path = os.path.join(os.path.dirname(path), data_file)
+    shape = tuple(int(n) for n in header["dim"].split(","))
+    return np.memmap(path, dtype=dtype, mode="r", offset=int(offset or 0), shape=(int(np.prod(shape)),))
+
+
+def negative_percent(path, chunk=1 << 24) -> float:
+    # read in chunks, the 4D DWI is never held in memory at once
+    data = mif_data(path)
+    negative = sum(int(np.count_nonzero(data[start:start + chunk] < 0)) for start in range(0, data.size, chunk))
+    return 100.0 * negative / max(data.size, 1)
+
+
+def qc_node_files(scrap_directory, units) -> dict:
+    """
+    The outputs of the nodes of QC_THRESHOLDED in the temporary folder, {unit: {metric: .mif file}},
+    found in one pass over the folder. Missing once the temporary folder has been deleted.
+    """
+    nodes = {node: metric for metric, node in QC_THRESHOLDED.items()}
+    files = {}
+    for root, _, names in os.walk(scrap_directory):
+        metric = nodes.get(os.path.basename(root))
+        unit = path_unit(root) if metric else None
+        if unit not in units:
+            continue
+        mifs = sorted(name for name in names if name.endswith(".mif"))
+        if mifs:
+            files.setdefault(unit, {})[metric] = os.path.join(root, mifs[0])
+    return files
+
+
+def unit_metrics(unit, out_dir, node_files=None) -> dict:
+    """
+    The QC metrics of one unit from its final outputs, on grids of about QC_GRID_MM:
+    the normalized mutual information of the b0 and the T2 in T1 space with the T1 where their grids overlap,
+    the fraction of the T1 brain (the head mask eroded by the scalp) with signal in the warped b0,
+    and the percentage of negative voxels each Threshold of the DWI preprocessing removed.
+    """
+    from scipy import ndimage
+
+    row = {"subject": unit}
+    paths = {}
+    for name, (folder, pattern) in QC_OUTPUTS.items():
+        found = sorted(glob.glob(os.path.join(out_dir, folder, unit_dir(unit), pattern)))
+        paths[name] = found[0] if found else None
+    row.update({metric: float("nan") for metric in QC_METRICS})
+    row["missing"] = ",".join(name for name, path in paths.items() if path is None)
+
+    if paths["t1"] is not None:
+        t1, t1_affine = downsampled(paths["t1"])
+        mask = head_mask(t1)
+        for name, metric in (("b0", "nmi_b0_t1"), ("t2", "nmi_t2_t1")):
+            if paths[name] is None:
+                continue
+            # the T1 at the voxels of the other image, its grid may differ with another output grid or cropping
+            moving, affine = downsampled(paths[name])
+            points = grid_points(moving.shape, affine)
+            inside = sample(np.ones(t1.shape, dtype=np.uint8), t1_affine, points) > 0
+            row[metric] = normalized_mutual_information(moving.ravel()[inside], sample(t1, t1_affine, points)[inside])
+            if name == "b0":
+                brain = ndimage.binary_erosion(mask, iterations=max(1, int(round(10.0 / QC_GRID_MM))))
+                covered = sample(moving, affine, grid_points(t1.shape, t1_affine)) > 0
+                row["coverage"] = float(np.count_nonzero(covered & brain.ravel()) / max(np.count_nonzero(brain), 1))
+
+    for metric, path in (node_files or {}).items():
+        try:
+            row[metric] = negative_percent(path)
+        except Exception as e:
+            print(f"QC of {unit}: {path} can't be read: {e}")
+    return row
+
+
+def flag_outliers(rows) -> list:
+    """
+    Status and flags of every unit from the metrics of the whole cohort at once: missing outputs,
+    too little coverage, and robust z-scores (median and MAD of the cohort) beyond QC_OUTLIER_Z.
+    """
+    flags = [[f"missing {row['missing']}"] if row["missing"] else [] for row in rows]
+    for metric, side in QC_METRICS.items():
+        values = np.array([row[metric] for row in rows], dtype=float)
+        valid = ~np.isnan(values)
+        if metric == "coverage":
+            for i in np.flatnonzero(valid & (values < QC_MIN_COVERAGE)):
+                flags[i].append("coverage")
+        if np.count_nonzero(valid) < QC_MIN_COHORT:
+            continue
+        median = np.median(values[valid])
+        mad = 1.4826 * np.median(np.abs(values[valid] - median))
+        if mad == 0:
+            continue
+        z = side * (values - median) / mad
+        for i in np.flatnonzero(valid & (z > QC_OUTLIER_Z)):
+            if metric not in flags[i]:
+                flags[i].append(metric)
+
+    for row, unit_flags in zip(rows, flags):
+        row["status"] = "missing" if row["missing"] else "fail" if unit_flags else "pass"
+        row["flags"] = ",".join(unit_flags)
+        del row["missing"]
+    return rows
+
+
+def cohort_qc(out_dir, units, scrap_directory=None, num_threads=1) -> list:
+    """
+    The QC rows of all the units, computed in parallel across units, see unit_metrics and flag_outliers.
+    """
+    node_files = qc_node_files(scrap_directory, set(units)) if scrap_directory else {}
+    with ProcessPoolExecutor(max_workers=max(1, min(num_threads, len(units)))) as pool:
+        rows = list(pool.map(unit_metrics, units, [out_dir] * len(units),
+                             [node_files.get(unit) for unit in units]))
+    return flag_outliers(rows)
+
+
+def write_qc(rows, out_dir) -> list:
+    """
+    Write the cohort table qc.tsv and the units to process again, one per line, to qc_failed.txt,
+    which --subjects_file takes. Returns those units.
+    """
+    from .planning import write_table
+
+    write_table([{key: row[key] for key in ["subject", "status", "flags"] + list(QC_METRICS)} for row in rows],
+                os.path.join(out_dir, QC_FILE))
+    failed = [row["subject"] for row in rows if row["status"] != "pass"]
+    with open(os.path.join(out_dir, QC_FAILED_FILE), "w") as f:
+        f.writelines(f"{unit}\n" for unit in failed)
+    return failed
+
+
+def print_qc(rows) -> None:
+    for row in rows:
+        if row["status"] != "pass":
+            print(f"QC {row['status']}: {row['subject']} {row['flags']}")
+    print(f"QC: {sum(row['status'] == 'pass' for row in rows)} of {len(rows)} subjects passed")
+
+
+def run_qc(out_dir, units, scrap_directory=None, num_threads=1) -> list:
+    rows = cohort_qc(out_dir, units, scrap_directory, num_threads)
+    print_qc(rows)
+    failed = write_qc(rows, out_dir)
+    if failed:
+        print(f"Process them again with --subjects_file {os.path.join(out_dir, QC_FAILED_FILE)}")
+    return rows
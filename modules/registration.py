@@ -1,89 +1,147 @@
-def registration_workflow(num_threads=1):
+def registration_workflow(num_threads=1, dwi_chunk_size=0, resample_memory_gb=4.0, resample_dwi=True,
+                          output_grid="t1", output_spacing=None, retry_dir=None):
     from nipype.pipeline.engine import Node, Workflow
     from nipype.interfaces.utility import IdentityInterface, Merge
-    from nipype.interfaces.ants import Registration, ApplyTransforms
+    from nipype.interfaces.ants import ApplyTransforms
+    from .resampling import chunked_apply_transforms_node, reference_grid_node
+    from .retry import RetryRegistration, RetryApplyTransforms
 
-    inputnode = Node(IdentityInterface(fields=["dwi_nifti", "mean_b0", "t1", "t2"]),
+    # the T2 to T1 transforms come from the anatomical branch, shared by all DWI units of an anatomical pair
+    inputnode = Node(IdentityInterface(fields=["dwi_nifti", "mean_b0", "t1", "t2", "t2_to_t1"]),
                      name="inputnode")
 
-    outputnode = Node(IdentityInterface(fields=["dwi", "t2"]), name="outputnode")
-
-    # Registration
-    reg_b0_to_t2 = Node(Registration(metric=["MI", "MI", "MI"],
-                                     transforms=["Rigid", "Affine", "SyN"],
-                                     metric_weight=[1, 1, 1],
-                                     number_of_iterations=[[500, 250, 100], [500, 250, 100],
-                                                           [75, 50, 0]],
-                                     convergence_threshold=[1.e-6, 1.e-6, 1.e-6],
-                                     convergence_window_size=[10] * 3,
-                                     shrink_factors=[[4, 2, 1], [4, 2, 1], [2, 2, 1]],
-                                     smoothing_sigmas=[[3, 2, 1], [3, 2, 1], [2, 1, 0]],
-                                     radius_or_number_of_bins=[32, 32, 4],
-                                     transform_parameters=[(0.1,), (0.1,), (0.2, 3, 0)],
-                                     sampling_strategy=["Regular", "Regular", "Random"],
-                                     sampling_percentage=[0.25, 0.25, 0.4],
-                                     use_histogram_matching=[False, False, False],
-                                     winsorize_lower_quantile=0.005,
-                                     winsorize_upper_quantile=0.995,
-                                     num_threads=num_threads,
-                                     float=True,
-                                     output_transform_prefix="b0ToT2_",
-                                     output_warped_image='warped_b0_to_T2.nii.gz',
-                                     output_inverse_warped_image='inverse_warped.nii.gz'),
-                        name="b0_to_T2")
+    outputnode = Node(IdentityInterface(fields=["dwi", "mean_b0", "composite_warp"]), name="outputnode")
 
-    # Registration
-    reg_t2_to_t1 = Node(Registration(metric=["MI", "MI", "MI"],
-                                     transforms=["Rigid", "Affine", "SyN"],
-                                     metric_weight=[1, 1, 1],
-                                     number_of_iterations=[[1000, 500, 250, 100], [1000, 500, 250, 100],
-                                                           [75, 50, 0]],
-                                     convergence_threshold=[1.e-6, 1.e-6, 1.e-6],
-                                     convergence_window_size=[10] * 3,
-                                     shrink_factors=[[8, 4, 2, 1], [8, 4, 2, 1], [2, 2, 1]],
-                                     smoothing_sigmas=[[3, 2, 1, 0], [3, 2, 1, 0], [2, 1, 0]],
-                                     radius_or_number_of_bins=[32, 32, 4],
-                                     transform_parameters=[(0.1,), (0.1,), (0.2, 3, 0)],
-                                     sampling_strategy=["Regular", "Regular", "Regular"],
-                                     sampling_percentage=[0.25, 0.25, 0.4],
-                                     use_histogram_matching=[False, False, False],
-                                     winsorize_lower_quantile=0.005,
-                                     winsorize_upper_quantile=0.995,
-                                     num_threads=num_threads,
-                                     float=True,
-                                     output_transform_prefix="T2ToT1_",
-                                     output_warped_image='warped_t2_to_t1.nii.gz',
-                                     output_inverse_warped_image='inverse_warped.nii.gz'),
-                        name="T2_to_T1")
+    # Registration, retried with fewer resources when it runs out of memory
+    reg_b0_to_t2 = Node(RetryRegistration(metric=["MI", "MI", "MI"],
+                                          transforms=["Rigid", "Affine", "SyN"],
+                                          metric_weight=[1, 1, 1],
+                                          number_of_iterations=[[500, 250, 100], [500, 250, 100],
+                                                                [75, 50, 0]],
+                                          convergence_threshold=[1.e-6, 1.e-6, 1.e-6],
+                                          convergence_window_size=[10] * 3,
+                                          shrink_factors=[[4, 2, 1], [4, 2, 1], [2, 2, 1]],
+                                          smoothing_sigmas=[[3, 2, 1], [3, 2, 1], [2, 1, 0]],
+                                          radius_or_number_of_bins=[32, 32, 4],
+                                          transform_parameters=[(0.1,), (0.1,), (0.2, 3, 0)],
+                                          sampling_strategy=["Regular", "Regular", "Random"],
+                                          sampling_percentage=[0.25, 0.25, 0.4],
+                                          use_histogram_matching=[False, False, False],
+                                          winsorize_lower_quantile=0.005,
+                                          winsorize_upper_quantile=0.995,
+                                          num_threads=num_threads,
+                                          float=True,
+                                          output_transform_prefix="b0ToT2_",
+                                          output_warped_image='warped_b0_to_T2.nii.gz',
+                                          output_inverse_warped_image='inverse_warped.nii.gz'),
+                        name="b0_to_T2")
+    if retry_dir:
+        reg_b0_to_t2.inputs.retry_dir = retry_dir
 
     merge_transforms = Node(Merge(2), name="merge_transform_lists")
 
-    apply_transforms = Node(ApplyTransforms(dimension=3,
-                                            input_image_type=3,
-                                            interpolation="Linear",
-                                            float=True,
-                                            num_threads=num_threads,
-                                            output_image='warped_dwi.nii.gz'),
-                            name="apply_transforms")
+    # Compose the affine and warp chain once into a single displacement field on the reference grid,
+    # so every further resampling (DWI volumes, b0, masks, derived maps) is one field lookup
+    compose_transforms = Node(ApplyTransforms(dimension=3,
+                                              print_out_composite_warp_file=True,
+                                              float=True,
+                                              num_threads=num_threads,
+                                              output_image='composite_warp.nii.gz'),
+                              name="compose_transforms")
+
+    if dwi_chunk_size > 0:
+        # resample the 4D DWI in volume chunks across several processes within the memory budget
+        apply_transforms = chunked_apply_transforms_node(num_threads, dwi_chunk_size, resample_memory_gb)
+    else:
+        # resampled in chunks only when it runs out of memory as a whole
+        apply_transforms = Node(RetryApplyTransforms(dimension=3,
+                                                     input_image_type=3,
+                                                     interpolation="Linear",
+                                                     float=True,
+                                                     num_threads=num_threads,
+                                                     output_image='warped_dwi.nii.gz'),
+                                name="apply_transforms")
+        if retry_dir:
+            apply_transforms.inputs.retry_dir = retry_dir
+
+    apply_transforms_b0 = Node(ApplyTransforms(dimension=3,
+                                               interpolation="Linear",
+                                               float=True,
+                                               num_threads=num_threads,
+                                               output_image='warped_mean_b0.nii.gz'),
+                               name="apply_transforms_b0")
 
     wf = Workflow(name="registration")
+
+    # the grid of the outputs in T1 space, either the T1 itself or a header-only grid over its field of view
+    if output_grid == "t1":
+        reference, reference_field = inputnode, "t1"
+    else:
+        reference, reference_field = reference_grid_node(output_grid, output_spacing), "reference_image"
+        wf.connect([
+            (inputnode, reference, [("t1", "t1"),
+                                    ("dwi_nifti", "dwi")]),
+        ])
+
     wf.connect([
         # FreeSurfer to native space
         (inputnode, reg_b0_to_t2, [("mean_b0", "moving_image")]),
         (inputnode, reg_b0_to_t2, [("t2", "fixed_image")]),
 
-        (inputnode, reg_t2_to_t1, [("t2", "moving_image")]),
-        (inputnode, reg_t2_to_t1, [("t1", "fixed_image")]),
-
-        (reg_t2_to_t1, merge_transforms, [("forward_transforms", "in1")]),
+        (inputnode, merge_transforms, [("t2_to_t1", "in1")]),
         (reg_b0_to_t2, merge_transforms, [("forward_transforms", "in2")]),
 
-        (inputnode, apply_transforms, [("t1", "reference_image")]),
-        (inputnode, apply_transforms, [("dwi_nifti", "input_image")]),
-        (merge_transforms, apply_transforms, [("out", "transforms")]),
+        (reference, compose_transforms, [(reference_field, "reference_image")]),
+        (inputnode, compose_transforms, [("mean_b0", "input_image")]),
+        (merge_transforms, compose_transforms, [("out", "transforms")]),
 
-        (apply_transforms, outputnode, [("output_image", "dwi")]),
-        (reg_t2_to_t1, outputnode, [("warped_image", "t2")])
+        (reference, apply_transforms_b0, [(reference_field, "reference_image")]),
+        (inputnode, apply_transforms_b0, [("mean_b0", "input_image")]),
+        (compose_transforms, apply_transforms_b0, [("output_image", "transforms")]),
+
+        (apply_transforms_b0, outputnode, [("output_image", "mean_b0")]),
+        (compose_transforms, outputnode, [("output_image", "composite_warp")])
     ])
 
+    if resample_dwi:
+        wf.connect([
+            (reference, apply_transforms, [(reference_field, "reference_image")]),
+            (inputnode, apply_transforms, [("dwi_nifti", "input_image")]),
+            (compose_transforms, apply_transforms, [("output_image", "transforms")]),
+
+            (apply_transforms, outputnode, [("output_image", "dwi")]),
+        ])
+
     return wf
+
+
+def t2_to_t1_registration(num_threads=1, retry_dir=None):
+    from nipype.pipeline.engine import Node
+    from .retry import RetryRegistration
+
+    # Registration of the preprocessed T2 to the T1, once per anatomical pair
+    reg = Node(RetryRegistration(metric=["MI", "MI", "MI"],
+                                 transforms=["Rigid", "Affine", "SyN"],
+                                 metric_weight=[1, 1, 1],
+                                 number_of_iterations=[[1000, 500, 250, 100], [1000, 500, 250, 100],
+                                                       [75, 50, 0]],
+                                 convergence_threshold=[1.e-6, 1.e-6, 1.e-6],
+                                 convergence_window_size=[10] * 3,
+                                 shrink_factors=[[8, 4, 2, 1], [8, 4, 2, 1], [2, 2, 1]],
+                                 smoothing_sigmas=[[3, 2, 1, 0], [3, 2, 1, 0], [2, 1, 0]],
+                                 radius_or_number_of_bins=[32, 32, 4],
+                                 transform_parameters=[(0.1,), (0.1,), (0.2, 3, 0)],
+                                 sampling_strategy=["Regular", "Regular", "Regular"],
+                                 sampling_percentage=[0.25, 0.25, 0.4],
+                                 use_histogram_matching=[False, False, False],
+                                 winsorize_lower_quantile=0.005,
+                                 winsorize_upper_quantile=0.995,
+                                 num_threads=num_threads,
+                                 float=True,
+                                 output_transform_prefix="T2ToT1_",
+                                 output_warped_image='warped_t2_to_t1.nii.gz',
+                                 output_inverse_warped_image='inverse_warped.nii.gz'),
+               name="T2_to_T1")
+    if retry_dir:
+        reg.inputs.retry_dir = retry_dir
+    return reg
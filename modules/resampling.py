@@ -0,0 +1,264 @@
+def chunked_apply_transforms(input_image, reference_image, transforms, chunk_size=32, num_threads=1,
+                             memory_gb=4.0, interpolation="Linear", out_file="warped_dwi.nii.gz"):
+    """
+    Resample a 4D series onto the reference grid in chunks of volumes.
+    Chunks are read from the input in a single sequential pass, resampled by concurrent
+    antsApplyTransforms processes (as many as fit into the memory budget), and appended
+    in order to the gzipped output, so neither series is ever held in memory as a whole.
+    """
+    import os
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    import nibabel as nib
+    import numpy as np
+    from nibabel.openers import Opener
+
+    from modules.resampling import iter_volume_chunks, chunk_workers, run_apply_transforms, _append_chunk
+
+    in_img = nib.load(input_image)
+    ref_img = nib.load(reference_image)
+    n_volumes = in_img.shape[3] if len(in_img.shape) > 3 else 1
+    chunk_size = max(1, min(int(chunk_size), n_volumes))
+
+    n_workers = chunk_workers(in_img.shape[:3], ref_img.shape[:3], chunk_size, num_threads, memory_gb)
+    threads_per_chunk = max(1, num_threads // n_workers)
+    print(f"Resampling {n_volumes} volumes in chunks of {chunk_size} with {n_workers} processes")
+
+    chunk_dir = os.path.abspath("chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunk_hdr = in_img.header.copy()
+    chunk_hdr.set_data_dtype(np.float32)
+
+    def resample(index, data):
+        chunk_in = os.path.join(chunk_dir, f"chunk_{index:04d}.nii")
+        chunk_out = os.path.join(chunk_dir, f"chunk_{index:04d}_warped.nii")
+        nib.Nifti1Image(data.astype(np.float32), in_img.affine, chunk_hdr).to_filename(chunk_in)
+        run_apply_transforms(chunk_in, reference_image, transforms, chunk_out,
+                             interpolation=interpolation, num_threads=threads_per_chunk)
+        os.remove(chunk_in)
+        return chunk_out
+
+    # header of the final series: reference grid, input number of volumes and repetition time
+    out_hdr = nib.Nifti1Header()
+    out_hdr.set_data_shape(tuple(ref_img.shape[:3]) + (n_volumes,))
+    out_hdr.set_data_dtype(np.float32)
+    # the chunks are appended as float32 values, so no scaling may apply to them when they are read
+    out_hdr.set_slope_inter(1, 0)
+    out_hdr.set_qform(ref_img.affine, code=1)
+    out_hdr.set_sform(ref_img.affine, code=1)
+    out_hdr.set_zooms(tuple(ref_img.header.get_zooms()[:3]) + (in_img.header.get_zooms()[3:4] or (1.0,)))
+    out_hdr.set_xyzt_units(*in_img.header.get_xyzt_units())
+    out_hdr.set_data_offset(out_hdr.single_vox_offset)
+
+    out_file = os.path.abspath(out_file)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool, Opener(out_file, "wb") as out:
+        out_hdr.write_to(out)
+        out.write(b"\x00" * (out_hdr.get_data_offset() - out.tell()))
+
+        # keep at most n_workers chunks in flight, the next chunk is read only when a slot frees up
+        pending = []
+        for index, data in iter_volume_chunks(input_image, chunk_size):
+            pending.append(pool.submit(resample, index, data))
+            del data
+            if len(pending) >= n_workers:
+                _append_chunk(out, pending.pop(0).result())
+        for future in pending:
+            _append_chunk(out, future.result())
+
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    return out_file
+
+
+def run_apply_transforms(input_image, reference_image, transforms, out_file, interpolation="Linear",
+                         num_threads=1) -> str:
+    """
+    Run antsApplyTransforms in a separate process, 4D inputs are resampled volume by volume.
+    """
+    import subprocess
+
+    import nibabel as nib
+    from nipype.interfaces.ants import ApplyTransforms
+
+    at = ApplyTransforms(dimension=3,
+                         input_image_type=3 if len(nib.load(input_image).shape) > 3 else 0,
+                         interpolation=interpolation,
+                         float=True,
+                         num_threads=num_threads,
+                         input_image=input_image,
+                         reference_image=reference_image,
+                         transforms=transforms,
+                         output_image=out_file)
+    subprocess.run(at.cmdline, shell=True, check=True, stdout=subprocess.DEVNULL)
+    return out_file
+
+
+def resample_dwi(dwi, composite_warp, reference, out_file, volumes=None, region=None,
+                 interpolation="Linear", num_threads=1) -> str:
+    """
+    Resample a native-space image onto the T1 grid on demand through the stored composite warp.
+    This is the library entry point for the transforms-only output mode: the sink keeps the
+    preprocessed DWI and the composite warp, and consumers pull only what they need.
+
+    volumes - indices of the DWI volumes to resample (all volumes by default)
+    region - ((x0, x1), (y0, y1), (z0, z1)) voxel ranges of the reference grid to resample
+    Masks, b0 and derived maps go through the same call, use interpolation="NearestNeighbor" for labels.
+    """
+    import os
+    import tempfile
+
+    import nibabel as nib
+    import numpy as np
+
+    out_file = os.path.abspath(out_file)
+    with tempfile.TemporaryDirectory() as tmp:
+        if volumes is not None:
+            img = nib.load(dwi)
+            data = np.stack([np.asarray(img.dataobj[..., int(v)], dtype=np.float32) for v in volumes], axis=-1)
+            hdr = img.header.copy()
+            hdr.set_data_dtype(np.float32)
+            dwi = os.path.join(tmp, "selected_volumes.nii.gz")
+            nib.Nifti1Image(data, img.affine, hdr).to_filename(dwi)
+
+        if region is not None:
+            ref_img = nib.load(reference)
+            ref_img = ref_img.slicer[tuple(slice(int(start), int(stop)) for start, stop in region)]
+            reference = os.path.join(tmp, "region_reference.nii.gz")
+            ref_img.to_filename(reference)
+
+        return run_apply_transforms(dwi, reference, [composite_warp], out_file,
+                                    interpolation=interpolation, num_threads=num_threads)
+
+
+def build_reference_grid(t1, dwi, output_grid="t1", output_spacing=None) -> str:
+    """
+    Build the output grid for the DWI in T1 space from the image headers only.
+    "t1" - the T1 grid itself
+    "dwi" - the T1 field of view at the native DWI voxel size
+    "custom" - the T1 field of view at output_spacing (one value or one per axis, in mm)
+    """
+    import os
+
+    import nibabel as nib
+    import numpy as np
+
+    from modules.resampling import reference_grid_geometry
+
+    if output_grid == "t1":
+        return t1
+
+    t1_img = nib.load(t1)
+    dwi_zooms = nib.load(dwi).header.get_zooms()[:3]
+    shape, affine = reference_grid_geometry(t1_img.affine, t1_img.shape, t1_img.header.get_zooms(), dwi_zooms,
+                                            output_grid, output_spacing)
+
+    grid = nib.Nifti1Image(np.zeros(shape, dtype=np.uint8), affine)
+    grid.header.set_xyzt_units(*t1_img.header.get_xyzt_units())
+    out_file = os.path.abspath("reference_grid.nii.gz")
+    grid.to_filename(out_file)
+    return out_file
+
+
+def reference_grid_geometry(t1_affine, t1_shape, t1_zooms, dwi_zooms, output_grid="t1", output_spacing=None) -> tuple:
+    """
+    Shape and affine of the output grid, the outer voxel edges coincide with the T1 field of view.
+    """
+    import numpy as np
+
+    zooms = np.array(t1_zooms[:3], dtype=float)
+    if output_grid == "t1":
+        return tuple(int(n) for n in t1_shape[:3]), np.asarray(t1_affine)
+    elif output_grid == "dwi":
+        spacing = np.array(dwi_zooms[:3], dtype=float)
+    else:
+        spacing = np.broadcast_to(np.asarray(output_spacing, dtype=float), (3,))
+
+    shape = np.maximum(np.ceil(np.array(t1_shape[:3]) * zooms / spacing), 1).astype(int)
+    scale = spacing / zooms
+    affine = np.array(t1_affine, dtype=float)
+    affine[:3, :3] = affine[:3, :3] * scale
+    affine[:3, 3] = np.asarray(t1_affine)[:3, :] @ np.append(-0.5 + 0.5 * scale, 1)
+    return tuple(int(n) for n in shape), affine
+
+
+def reference_grid_node(output_grid="t1", output_spacing=None):
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.utility import Function
+
+    node = Node(Function(input_names=["t1", "dwi", "output_grid", "output_spacing"],
+                         output_names=["reference_image"],
+                         function=build_reference_grid),
+                name="reference_grid")
+    node.inputs.output_grid = output_grid
+    node.inputs.output_spacing = output_spacing
+    return node
+
+
+def _append_chunk(out, chunk_file):
+    import os
+
+    import nibabel as nib
+    import numpy as np
+
+    data = np.asarray(nib.load(chunk_file).dataobj, dtype=np.float32)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    out.write(data.tobytes(order="F"))
+    os.remove(chunk_file)
+
+
+def iter_volume_chunks(in_file, chunk_size):
+    """
+    Yield (chunk index, data) pairs of consecutive volumes of a 4D NIfTI image.
+    The file is read once from front to back, which also keeps gzipped inputs cheap.
+    """
+    import nibabel as nib
+    import numpy as np
+    from nibabel.openers import Opener
+
+    img = nib.load(in_file)
+    hdr = img.header
+    shape = img.shape if len(img.shape) > 3 else img.shape + (1,)
+    dtype = hdr.get_data_dtype()
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    volume_bytes = int(np.prod(shape[:3])) * dtype.itemsize
+
+    with Opener(in_file, "rb") as f:
+        f.seek(img.dataobj.offset)
+        for index, start in enumerate(range(0, shape[3], chunk_size)):
+            n = min(chunk_size, shape[3] - start)
+            data = np.frombuffer(f.read(volume_bytes * n), dtype=dtype)
+            data = data.reshape(tuple(shape[:3]) + (n,), order="F")
+            if slope != 1 or inter != 0:
+                data = data * slope + inter
+            yield index, data
+
+
+def chunk_workers(in_shape, ref_shape, chunk_size, num_threads, memory_gb) -> int:
+    """
+    Number of concurrent chunk resamplings that fit into the memory budget.
+    Each process holds its float32 input chunk, its float32 output chunk and a
+    displacement field on the reference grid.
+    """
+    import numpy as np
+
+    in_voxels = int(np.prod(in_shape[:3]))
+    ref_voxels = int(np.prod(ref_shape[:3]))
+    per_process = 4 * (in_voxels * chunk_size + ref_voxels * chunk_size + 3 * ref_voxels)
+    budget = int(memory_gb * 1024 ** 3)
+    return int(max(1, min(num_threads, budget // max(per_process, 1))))
+
+
+def chunked_apply_transforms_node(num_threads=1, chunk_size=32, memory_gb=4.0):
+    from nipype.pipeline.engine import Node
+    from nipype.interfaces.utility import Function
+
+    node = Node(Function(input_names=["input_image", "reference_image", "transforms",
+                                      "chunk_size", "num_threads", "memory_gb"],
+                         output_names=["output_image"],
+                         function=chunked_apply_transforms),
+                name="apply_transforms", n_procs=num_threads, mem_gb=memory_gb)
+    node.inputs.chunk_size = chunk_size
+    node.inputs.num_threads = num_threads
+    node.inputs.memory_gb = memory_gb
+    return node
@@ -0,0 +1,181 @@
+import fcntl
+import glob
+import json
+import os
+import socket
+import time
+
+from nipype.interfaces.ants import Registration, ApplyTransforms
+from nipype.interfaces.ants.registration import RegistrationInputSpec
+from nipype.interfaces.ants.resampling import ApplyTransformsInputSpec
+from nipype.interfaces.base import BaseInterfaceInputSpec, Directory
+
+from .mrtrix3_extra_interfaces import DWIPreprocCustom, DWIPreprocCustomInputSpec
+from .planning import node_unit
+
+RETRY_DIR = "retries"
+# a process killed by the OOM killer (SIGKILL, 128 + 9 through the shell), or a failed allocation reported
+# on its output; any other failure, e.g. of the arguments or the inputs, fails the node right away
+RESOURCE_RETURN_CODES = {-9, 137}
+RESOURCE_MESSAGES = ("std::bad_alloc", "memoryerror", "cannot allocate memory", "out of memory")
+# volumes per chunk when a 4D resampling falls back to chunked execution
+RETRY_CHUNK_SIZE = 8
+
+
+def is_resource_failure(runtime) -> bool:
+    if runtime.returncode in RESOURCE_RETURN_CODES:
+        return True
+    output = "\n".join(text for text in (runtime.stderr, runtime.stdout, runtime.merged) if text).lower()
+    return runtime.returncode != 0 and any(message in output for message in RESOURCE_MESSAGES)
+
+
+def retry_history(retry_dir) -> list:
+    # the attempts of all earlier runs, one events file per process like the progress events
+    attempts = []
+    for path in sorted(glob.glob(os.path.join(retry_dir, "*.jsonl"))):
+        with open(path) as f:
+            attempts.extend(json.loads(line) for line in f if line.strip())
+    return attempts
+
+
+def step_rank(step) -> tuple:
+    # how much a step gives up to fit into memory, chunked beyond exclusive beyond fewer threads
+    return step["chunk_size"] > 0, step["exclusive"], -step["threads"]
+
+
+class ResourceRetryInputSpec(BaseInterfaceInputSpec):
+    retry_dir = Directory(desc="folder of the retry history and of the lock of the exclusive slot", nohash=True)
+
+
+class ResourceRetry:
+    """
+    Mixin of the command line interfaces that run out of memory on large subjects. A run killed for lack of
+    memory is repeated with fewer threads, then alone among the retried nodes of the host (an exclusive slot,
+    so no other retried node competes for the memory), and then in chunks where the interface can, before the
+    node fails as it would without retries. The chunks are tried by the interfaces which define
+    _run_chunked(runtime, step) only. Every attempt of a node that needed a retry is appended to the
+    history in retry_dir, and the node of the same unit starts from the step that succeeded in later runs.
+    """
+    def _threads(self) -> int:
+        return self.inputs.num_threads
+
+    def _set_threads(self, threads) -> None:
+        self.inputs.num_threads = threads
+
+    def _steps(self) -> list:
+        threads = max(1, int(self._threads()))
+        steps = [{"threads": n, "exclusive": False, "chunk_size": 0}
+                 for n in sorted({threads, max(1, threads // 2), 1}, reverse=True)]
+        steps.append({"threads": 1, "exclusive": True, "chunk_size": 0})
+        if hasattr(self, "_run_chunked"):
+            steps.append({"threads": 1, "exclusive": True, "chunk_size": RETRY_CHUNK_SIZE})
+        return steps
+
+    def _retry_dir(self) -> str:
+        retry_dir = getattr(self.inputs, "retry_dir", None)
+        return retry_dir if isinstance(retry_dir, str) and retry_dir else None
+
+    def _run_interface(self, runtime, correct_return_codes=(0,)):
+        node = os.path.basename(runtime.cwd)
+        # the same key when the history is written and looked up, also for the nodes of an anatomical pair
+        unit = node_unit(runtime.cwd) or ""
+        retry_dir = self._retry_dir()
+
+        steps = self._steps()
+        first = steps[0]
+        # pre-sized from the step which succeeded for this node and unit before, nothing is tried twice
+        if retry_dir:
+            done = [attempt["step"] for attempt in retry_history(retry_dir)
+                    if attempt["node"] == node and attempt["unit"] == unit and attempt["returncode"] == 0]
+            if done:
+                start = next((i for i, step in enumerate(steps) if step_rank(step) >= step_rank(done[-1])),
+                             len(steps) - 1)
+                steps = steps[start:]
+
+        attempts = []
+        for index, step in enumerate(steps):
+            self._set_threads(step["threads"])
+            started = time.time()
+            lock = None
+            try:
+                if step["exclusive"]:
+                    lock_dir = retry_dir or runtime.cwd
+                    os.makedirs(lock_dir, exist_ok=True)
+                    lock = open(os.path.join(lock_dir, f"exclusive-{socket.gethostname()}.lock"), "w")
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                if step["chunk_size"]:
+                    runtime = self._run_chunked(runtime, step)
+                else:
+                    runtime = super()._run_interface(runtime, correct_return_codes)
+            finally:
+                if lock is not None:
+                    lock.close()
+            resource_failure = runtime.returncode not in correct_return_codes and is_resource_failure(runtime)
+            attempts.append({"time": started, "node": node, "unit": unit, "attempt": index, "step": step,
+                             "returncode": runtime.returncode, "resource_failure": resource_failure,
+                             "seconds": time.time() - started})
+            if not resource_failure or index == len(steps) - 1:
+                break
+            print(f"{node} of {unit or 'this unit'} ran out of memory with {step['threads']} threads"
+                  f"{' alone' if step['exclusive'] else ''}, retrying")
+
+        # only nodes which needed (or were pre-sized from) a retry are recorded
+        if retry_dir and (len(attempts) > 1 or steps[0] != first):
+            os.makedirs(retry_dir, exist_ok=True)
+            with open(os.path.join(retry_dir, f"{socket.gethostname()}-{os.getpid()}.jsonl"), "a") as f:
+                f.writelines(json.dumps(attempt) + "\n" for attempt in attempts)
+        return runtime
+
+
+class RetryRegistrationInputSpec(RegistrationInputSpec, ResourceRetryInputSpec):
+    pass
+
+
+class RetryRegistration(ResourceRetry, Registration):
+    input_spec = RetryRegistrationInputSpec
+
+
+class RetryApplyTransformsInputSpec(ApplyTransformsInputSpec, ResourceRetryInputSpec):
+    pass
+
+
+class RetryApplyTransforms(ResourceRetry, ApplyTransforms):
+    """
+    ApplyTransforms of a 4D series, the last retry resamples it in chunks of volumes, see
+    modules.resampling.chunked_apply_transforms.
+    """
+    input_spec = RetryApplyTransformsInputSpec
+
+    def _run_chunked(self, runtime, step):
+        import subprocess
+
+        from .resampling import chunked_apply_transforms
+
+        try:
+            chunked_apply_transforms(self.inputs.input_image, self.inputs.reference_image, self.inputs.transforms,
+                                     step["chunk_size"], step["threads"], memory_gb=0.0,
+                                     interpolation=self.inputs.interpolation,
+                                     out_file=self._gen_filename("output_image"))
+            runtime.returncode = 0
+        except subprocess.CalledProcessError as e:
+            runtime.returncode = e.returncode
+        except MemoryError:
+            runtime.returncode = -9
+        return runtime
+
+
+class RetryDWIPreprocInputSpec(DWIPreprocCustomInputSpec, ResourceRetryInputSpec):
+    pass
+
+
+class RetryDWIPreproc(ResourceRetry, DWIPreprocCustom):
+    input_spec = RetryDWIPreprocInputSpec
+
+    def _threads(self) -> int:
+        return self.inputs.nthreads
+
+    def _set_threads(self, threads) -> None:
+        # eddy_openmp reads its thread count from the environment, the MRtrix3 commands from -nthreads
+        self.inputs.nthreads = threads
+        self.inputs.environ = dict(self.inputs.environ, OMP_NUM_THREADS=str(threads))
+
@@ -0,0 +1,43 @@
+import heapq
+
+
+def order_subjects(subjects, costs, policy="alphabetical") -> list:
+    """
+    Order in which the subjects are handed to the workers.
+    "alphabetical" - the order of the BIDS layout
+    "longest_first" - the most expensive subjects first, so no large subject is left running alone at the end
+    """
+    if policy == "longest_first":
+        return sorted(subjects, key=lambda subject: (-costs[subject], subject))
+    return sorted(subjects)
+
+
+def list_schedule(subjects, costs, slots) -> float:
+    """
+    Makespan of handing the subjects in the given order to the first free of the parallel slots.
+    """
+    free_at = [0.0] * max(int(slots), 1)
+    for subject in subjects:
+        heapq.heappush(free_at, heapq.heappop(free_at) + costs[subject])
+    return max(free_at)
+
+
+def makespan_report(subjects, costs, slots) -> list:
+    total = sum(costs[subject] for subject in subjects)
+    lower_bound = max(total / max(slots, 1), max(costs.values(), default=0.0))
+    rows = []
+    for policy in ("alphabetical", "longest_first"):
+        makespan = list_schedule(order_subjects(subjects, costs, policy), costs, slots)
+        rows.append({"order": policy,
+                     "makespan_hours": makespan,
+                     "idle_percent": 100.0 * (1 - total / (makespan * slots)) if makespan > 0 else 0.0,
+                     "over_lower_bound_percent": 100.0 * (makespan / lower_bound - 1) if lower_bound > 0 else 0.0})
+    return rows
+
+
+def print_makespan_report(rows, slots) -> None:
+    print(f"Estimated makespan with {slots} parallel subject(s):")
+    print(f"{'order':<16}{'makespan h':>12}{'idle %':>9}{'over bound %':>14}")
+    for row in rows:
+        print(f"{row['order']:<16}{row['makespan_hours']:>12.2f}{row['idle_percent']:>9.1f}"
+              f"{row['over_lower_bound_percent']:>14.1f}")
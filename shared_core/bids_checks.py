@@ -1,13 +1,16 @@
 import json
 import os
+import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Tuple, Optional
 
 from bids.layout import BIDSLayout
 from bids.exceptions import BIDSValidationError
 
-from shared_core.utils import continuously_ask_user_yn
+from shared_core.utils import (continuously_ask_user_yn, ask_user, has_answers, get_answer, MissingAnswerError,
+                               transfer_file)
 
 
 def get_filename(fn) -> str:
@@ -19,6 +22,49 @@ def get_filename(fn) -> str:
     return fn.stem
 
 
+def compile_patterns(patterns):
+    """
+    One regular expression for comma separated patterns, matched anywhere in a path.
+    """
+    return re.compile("|".join(re.escape(pattern.strip()) for pattern in patterns.split(",") if pattern.strip()))
+
+
+class FileIndex:
+    """
+    Files of the input folder bucketed by subject once. A file belongs to the subject folder it is in,
+    files outside the subject folders to the subject whose name is in their path.
+    Metadata files are looked up by the file name of their image.
+    """
+
+    def __init__(self, work_dir, subjects, nifti_files, meta_files) -> None:
+        self._nifti = {subj: [] for subj in subjects}
+        self._meta = {subj: {} for subj in subjects}
+        # the longest name first, so a file of subject s10 does not end up in s1
+        self._by_length = sorted(subjects, key=len, reverse=True)
+        self.work_dir = work_dir
+
+        for f in nifti_files:
+            subj = self._subject_of(f)
+            if subj is not None:
+                self._nifti[subj].append(f)
+        for f in meta_files:
+            subj = self._subject_of(f)
+            if subj is not None:
+                self._meta[subj].setdefault(get_filename(f), []).append(f)
+
+    def _subject_of(self, f) -> Optional[str]:
+        top = os.path.relpath(f, self.work_dir).split(os.sep)[0]
+        if top in self._nifti:
+            return top
+        return next((subj for subj in self._by_length if subj in f), None)
+
+    def match(self, subj, matcher) -> list:
+        return [f for f in self._nifti[subj] if matcher.search(f)]
+
+    def meta(self, subj, name) -> list:
+        return self._meta[subj].get(name, [])
+
+
 class BIDS:
     def __init__(self, work_dir, subjects) -> None:
         self.layout = None
@@ -67,7 +113,7 @@ class BIDS:
                 print("Probably your dataset is not valid BIDS dataset.")
                 print("If your dataset is valid BIDS dataset, please create this file and try again.")
                 print("Otherwise, do you want to try this pipeline to convert your dataset into a BIDS format?")
-                yn = continuously_ask_user_yn()
+                yn = continuously_ask_user_yn(key="convert_to_bids")
                 if yn == "y":
                     self.convert_to_bids = True
                 else:
@@ -81,7 +127,7 @@ class BIDS:
         if self.n_subjects_bids == 0 and len(self.nifti_files) > 1:
             print("We found NIFTI files in the provided input directory, but no subjects in the BIDS layout.")
             print("Do you want to try this pipeline to convert your dataset into a BIDS format?")
-            yn = continuously_ask_user_yn()
+            yn = continuously_ask_user_yn(key="convert_to_bids")
             if yn == "y":
                 self.convert_to_bids = True
             else:
@@ -95,7 +141,7 @@ class BIDS:
             print("Number of subjects in BIDS format is less than number of detected subjects in the input directory.")
             print("Please make sure that you have the correct BIDS layout.")
             print("If you want to continue processing only the detected subjects, please answer 'y'.")
-            bids_ask = continuously_ask_user_yn()
+            bids_ask = continuously_ask_user_yn(key="continue_with_detected_subjects")
             if bids_ask == "y":
                 print("Continue processing only the detected subjects.")
                 self.bids_ok = True
@@ -120,7 +166,7 @@ class BIDS:
                   "within the input folder or specify a new one?")
             print("If you want to use the input folder, please answer 'y', "
                   "if you want another one, please specify the FULL absolute path.")
-            option = input()
+            option = ask_user("", "bids_folder")
             if option.lower() == "y":
                 bids_folder = self.work_dir
             else:
@@ -134,7 +180,7 @@ class BIDS:
 
             self.work_dir = bids_folder
             print("What is the name of your dataset?")
-            dataset_name = input("[My Dataset by default]: ")
+            dataset_name = ask_user("[My Dataset by default]: ", "dataset_name")
             if dataset_name == "":
                 dataset_name = "My Dataset"
 
@@ -153,6 +199,14 @@ class BIDS:
             subjects_digits_len = len(str(len(self.subjects)))
             if subjects_digits_len == 1:
                 subjects_digits_len = 2
+
+            # every file is looked at once: bucketed by subject, matched against the precompiled patterns
+            index = FileIndex(self.work_dir, self.subjects, self.nifti_files, self.meta_files)
+            matchers = [(suffix, data_type, compile_patterns(patterns) if is_used else None)
+                        for suffix, data_type, is_used, patterns in (("T1w", "anat", is_t1, t1_patterns),
+                                                                     ("T2w", "anat", is_t2, t2_patterns),
+                                                                     ("dwi", "dwi", is_dwi, dwi_patterns))]
+            transfers = []
             for ind, subj in enumerate(self.subjects, start=1):
                 print(f"Processing subject {subj}")
                 new_ind = str(ind).zfill(subjects_digits_len)
@@ -163,47 +217,29 @@ class BIDS:
 
                 # create subject folder structure with new name
                 new_sub_folder = os.path.join(bids_folder, new_sub)
-                os.makedirs(new_sub_folder, exist_ok=True)
                 os.makedirs(os.path.join(new_sub_folder, "anat"), exist_ok=True)
                 os.makedirs(os.path.join(new_sub_folder, "dwi"), exist_ok=True)
 
-                # find MR images
-                all_locals_t1 = []
-                all_locals_t2 = []
-                all_locals_dwi = []
-
-                for f in self.nifti_files:
-                    t1 = self.find_modality_for_subject(is_t1, t1_patterns, subj, f)
-                    all_locals_t1.append(t1) if t1 is not None else None
-                    t2 = self.find_modality_for_subject(is_t2, t2_patterns, subj, f)
-                    all_locals_t2.append(t2) if t2 is not None else None
-                    dwi = self.find_modality_for_subject(is_dwi, dwi_patterns, subj, f)
-                    all_locals_dwi.append(dwi) if dwi is not None else None
-
-                # copy images to new folder in BIDS format
-                t1_name = self.copy_images_to_bids(all_locals_t1, "anat", new_sub_folder, subj,
-                                                   new_sub + "_T1w.nii.gz")
-                t2_name = self.copy_images_to_bids(all_locals_t2, "anat", new_sub_folder, subj,
-                                                   new_sub + "_T2w.nii.gz")
-                dwi_name = self.copy_images_to_bids(all_locals_dwi, "dwi", new_sub_folder, subj,
-                                                    new_sub + "_dwi.nii.gz")
-
-                # find metadata for MR images (.json and .bval/.bvec)
-                # and copy metadata to new folder in BIDS format
-                for f in self.meta_files:
-                    if t1_name in f and "json" in f:
-                        shutil.copy(f, os.path.join(new_sub_folder, "anat", new_sub + "_T1w.json"))
-                    if t2_name in f and "json" in f:
-                        shutil.copy(f, os.path.join(new_sub_folder, "anat", new_sub + "_T2w.json"))
-                    if dwi_name in f and "json" in f:
-                        shutil.copy(f, os.path.join(new_sub_folder, "dwi", new_sub + "_dwi.json"))
-                    if dwi_name in f and "bval" in f:
-                        shutil.copy(f, os.path.join(new_sub_folder, "dwi", new_sub + "_dwi.bval"))
-                    if dwi_name in f and "bvec" in f:
-                        shutil.copy(f, os.path.join(new_sub_folder, "dwi", new_sub + "_dwi.bvec"))
-
-                # clean up
-                shutil.rmtree(os.path.join(bids_folder, subj))
+                for suffix, data_type, matcher in matchers:
+                    # find MR images
+                    all_locals = index.match(subj, matcher) if matcher is not None else []
+                    image = self.select_image(all_locals, suffix, subj, f"{new_sub}_{suffix}.nii.gz")
+                    if image is None:
+                        continue
+                    transfers.append((image, os.path.join(new_sub_folder, data_type, f"{new_sub}_{suffix}.nii.gz")))
+
+                    # metadata of the image (.json and .bval/.bvec for DWI) with the same file name
+                    for meta in index.meta(subj, get_filename(image)):
+                        extension = os.path.splitext(meta)[1]
+                        if extension == ".json" or (suffix == "dwi" and extension in (".bval", ".bvec")):
+                            transfers.append((meta, os.path.join(new_sub_folder, data_type,
+                                                                 f"{new_sub}_{suffix}{extension}")))
+
+            # link (or copy across filesystems) the files in parallel, then clean up
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+                list(pool.map(lambda transfer: transfer_file(*transfer, mode="link"), transfers))
+            for subj in self.subjects:
+                shutil.rmtree(os.path.join(bids_folder, subj), ignore_errors=True)
 
             print("T1 images will have a suffix '_T1w', T2 images will have a suffix '_T2w'"
                   " and DWI images will have a suffix '_dwi'.")
@@ -219,6 +255,14 @@ class BIDS:
         is_modality = False
         patterns = None
 
+        # in the config file "modalities": {"<modality>": "<patterns>" or false}
+        if has_answers():
+            patterns = get_answer(f"modalities.{modality}")
+            print(f"{modality} patterns: {patterns} (from the config file)")
+            if patterns is False or patterns is None:
+                return False, None
+            return True, str(patterns) or f"{modality}"
+
         print(f"Do you have {modality} images?")
         ask = continuously_ask_user_yn()
         if ask == "y":
@@ -231,30 +275,25 @@ class BIDS:
         return is_modality, patterns
 
     @staticmethod
-    def find_modality_for_subject(is_used, patterns, subj, f) -> Optional[str]:
-        if is_used:
-            for pattern in patterns.split(","):
-                if pattern.strip() in f and subj in f:
-                    return f
-        return None
-
-    @staticmethod
-    def copy_images_to_bids(all_locals, data_type, new_sub_folder, subj, fn_new) -> str:
+    def select_image(all_locals, modality, subj, fn_new) -> Optional[str]:
         if len(all_locals) == 1:
-            shutil.copy(all_locals[0], os.path.join(new_sub_folder, data_type, fn_new))
-            return get_filename(all_locals[0])
+            return all_locals[0]
         elif len(all_locals) == 0:
-            print(f"No T1 images found for subject {subj}!")
+            print(f"No {modality} images found for subject {subj}!")
             print("You would need to fix this manually, "
                   "otherwise this subject won't be processed in the pipeline!")
-            return ""
+            return None
         else:
-            print(f"Multiple T1 images found for subject {subj}!")
+            print(f"Multiple {modality} images found for subject {subj}!")
             print("Please specify the index of which one you want to use.")
             for ind, f in enumerate(all_locals):
                 print(f"{ind}: {f}")
             print("Please enter the index of the image you want to use.")
             while True:
+                if has_answers():
+                    index_to_use = BIDS.configured_index(subj, fn_new, len(all_locals))
+                    print(f"{index_to_use} (from the config file)")
+                    break
                 index_to_use = input()
                 try:
                     index_to_use = int(index_to_use)
@@ -263,8 +302,20 @@ class BIDS:
                 else:
                     break
 
-            shutil.copy(all_locals[index_to_use], os.path.join(new_sub_folder, data_type, fn_new))
-            return get_filename(all_locals[index_to_use])
+            return all_locals[index_to_use]
+
+    @staticmethod
+    def configured_index(subj, fn_new, n_images) -> int:
+        # "image_index": {"<subject>": {"T1w": 1}, "default": 0}, the subject's entry first
+        modality = get_filename(fn_new).split("_")[-1]
+        try:
+            index = get_answer(f"image_index.{subj}.{modality}")
+        except MissingAnswerError:
+            index = get_answer("image_index.default")
+        if not isinstance(index, int) or not 0 <= index < n_images:
+            raise MissingAnswerError(f"image_index {index} for {modality} of subject {subj} "
+                                     f"is not between 0 and {n_images - 1}")
+        return index
 
     def is_bids(self) -> bool:
         return self.bids_ok
@@ -272,5 +323,8 @@ class BIDS:
     def get_work_dir(self) -> str:
         return self.work_dir
 
+    def get_layout(self) -> BIDSLayout:
+        return self.layout
+
     def get_bids_subjects(self) -> list:
         return self.bids_subjects
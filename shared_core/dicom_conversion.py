@@ -45,7 +45,8 @@ class DICOM:
                 # deal with a scenario when some the files are converted and some are not
                 print("The number of original subjects and the number of subjects with dicom files do not match!")
                 self.ask_convert = continuously_ask_user_yn(f"Convert all dicom files to nifti and store them in the "
-                                                            f"original folder: {self.args.input}?")
+                                                            f"original folder: {self.args.input}?",
+                                                            key="convert_dicom")
                 self.partial_conversion = True
 
     def run_conversion(self) -> str:
@@ -87,7 +88,7 @@ class DICOM:
                 exit(0)
 
             # delete the dicom files?
-            ask_delete = continuously_ask_user_yn("Delete DICOM files?")
+            ask_delete = continuously_ask_user_yn("Delete DICOM files?", key="delete_dicom")
             if ask_delete == "y":
                 self.delete_dicoms(self.all_dicom_files)
 
@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import os
 
 
@@ -20,6 +21,116 @@ class Parser:
                                  default=os.cpu_count(), type=int)
         self.parser.add_argument('--final_cleanup', '-fc', help='Remove the temp folder after registration',
                                  default=None, type=bool)
+        self.parser.add_argument('--dwi_chunk_size', '-dc', help='Resample the 4D DWI into T1 space in chunks of '
+                                                                 'this many volumes in parallel processes '
+                                                                 '(default 0, a single process for the whole series)',
+                                 default=0, type=int)
+        self.parser.add_argument('--resample_memory_gb', '-rm', help='Memory budget in GB for the chunked DWI '
+                                                                     'resampling (default 4)',
+                                 default=4.0, type=float)
+        self.parser.add_argument('--output_mode', '-om', help='"resampled" writes the DWI resampled into T1 space, '
+                                                              '"transforms" writes only the composite warp and the '
+                                                              'preprocessed native-space DWI (default resampled)',
+                                 default='resampled', choices=['resampled', 'transforms'])
+        self.parser.add_argument('--output_grid', '-og', help='Grid of the outputs in T1 space: "t1" the T1 grid, '
+                                                              '"dwi" the T1 field of view at the DWI voxel size, '
+                                                              '"custom" the T1 field of view at --output_spacing '
+                                                              '(default t1)',
+                                 default='t1', choices=['t1', 'dwi', 'custom'])
+        self.parser.add_argument('--output_spacing', '-os', help='Voxel size in mm of the "custom" output grid, '
+                                                                 'one value or one per axis',
+                                 default=None, type=float, nargs='+')
+        self.parser.add_argument('--crop', '-cr', help='Crop the inputs to a padded bounding box of the head before '
+                                                       'preprocessing: "restore" puts the outputs back on the T1 grid, '
+                                                       '"declared" keeps them cropped and writes the crop records '
+                                                       'next to them, "off" processes the full field of view '
+                                                       '(default off)',
+                                 default='off', choices=['off', 'declared', 'restore'])
+        self.parser.add_argument('--crop_padding', '-cp', help='Margin in mm around the head bounding box (default 10)',
+                                 default=10.0, type=float)
+        self.parser.add_argument('--dwi_runs', '-dr', help='Several DWI runs of a subject: "first" processes the '
+                                                           'first run only, "concat" concatenates all runs with '
+                                                           'their gradients and preprocesses them together '
+                                                           '(default first)',
+                                 default='first', choices=['first', 'concat'])
+        self.parser.add_argument('--eddy_tier', '-et', help='Eddy correction tier: "quick" with few iterations for '
+                                                            'checks and pilots, "reduced", or "full" with the eddy '
+                                                            'defaults (default full)',
+                                 default='full', choices=['quick', 'reduced', 'full'])
+        self.parser.add_argument('--scratch', '-sr', help='Node-local folder (SSD, tmpfs) for the temporary files, '
+                                                          'the inputs of every subject are staged there and only '
+                                                          'the final outputs are written to the output folder',
+                                 default=None, type=os.path.abspath)
+        self.parser.add_argument('--sink_mode', '-sm', help='How the final outputs get out of the temp folder: '
+                                                            '"copy", "link" (reflink or hardlink) or "move", both '
+                                                            'fall back to copying across filesystems (default copy)',
+                                 default='copy', choices=['copy', 'link', 'move'])
+        self.parser.add_argument('--parallel_subjects', '-ps', help='Number of subjects processed at the same time, '
+                                                                    'the threads are split between them (default 1)',
+                                 default=1, type=int)
+        self.parser.add_argument('--order', '-or', help='Order of the subjects: "alphabetical" or "longest_first" '
+                                                        'by the cost estimated from the image headers '
+                                                        '(default alphabetical)',
+                                 default='alphabetical', choices=['alphabetical', 'longest_first'])
+        self.parser.add_argument('--queue', '-q', help='Write one work item per subject into <output>/queue '
+                                                       'for --worker processes and exit',
+                                 action='store_true')
+        self.parser.add_argument('--worker', '-w', help='Process subjects from <output>/queue until it is empty, '
+                                                        'any number of workers on any host sharing the folder',
+                                 action='store_true')
+        self.parser.add_argument('--lease_seconds', '-ls', help='A work item claimed by a worker which stopped '
+                                                                'responding for this long is queued again '
+                                                                '(default 600)',
+                                 default=600, type=int)
+        self.parser.add_argument('--shard_index', '-si', help='Process only the subjects of this shard '
+                                                              '(0 to --shard_count - 1), e.g. the array task id',
+                                 default=None, type=int)
+        self.parser.add_argument('--shard_count', '-sc', help='Number of shards the subjects are split into',
+                                 default=None, type=int)
+        self.parser.add_argument('--shard_by', '-sb', help='"stride" deals the sorted subjects out in turn, '
+                                                           '"hash" keeps every subject in the same shard when '
+                                                           'subjects are added later (default stride), '
+                                                           'sessions sharing an anatomical pair stay together',
+                                 default='stride', choices=['stride', 'hash'])
+        self.parser.add_argument('--merge', '-mg', help='Check that the outputs of all subjects are complete, '
+                                                        'e.g. after all the shards have finished',
+                                 action='store_true')
+        self.parser.add_argument('--qc', '-qc', help='Quality metrics of the outputs of all subjects in one table, '
+                                                     '<output>/qc.tsv: "after" once the run has finished, "only" on '
+                                                     'the existing outputs without running anything (default off)',
+                                 default='off', choices=['off', 'after', 'only'])
+        self.parser.add_argument('--subjects_file', '-sf', help='Process only the subjects (or sub_ses-session '
+                                                                'units) listed one per line in this file, e.g. '
+                                                                'the <output>/qc_failed.txt of --qc',
+                                 default=None, type=os.path.abspath)
+        self.parser.add_argument('--watch', '-wa', help='Keep running and process new subject or session folders '
+                                                         'as they appear in the input directory',
+                                 action='store_true')
+        self.parser.add_argument('--poll_seconds', '-pl', help='Seconds between checks of the input directory '
+                                                               'in --watch mode (default 30)',
+                                 default=30, type=int)
+        self.parser.add_argument('--settle_seconds', '-st', help='A new folder is processed once its files have '
+                                                                 'not changed for this long (default 120)',
+                                 default=120, type=int)
+        self.parser.add_argument('--preflight', '-pf', help='"exclude" checks the headers, gradients and sidecars of '
+                                                            'all subjects before the workflow is built and leaves out '
+                                                            'the subjects which would fail, "off" skips the checks '
+                                                            '(default exclude)',
+                                 default='exclude', choices=['exclude', 'off'])
+        self.parser.add_argument('--plan', '-p', help='Only estimate per subject wall time, memory and scratch space '
+                                                      'from the image headers, nothing is executed',
+                                 action='store_true')
+        self.parser.add_argument('--status_port', '-sp', help='Serve the progress of the run as JSON at '
+                                                              'http://127.0.0.1:<port>/, it is always written to '
+                                                              '<output>/progress/<run>/status.json, <run> is the '
+                                                              'shard or <host>-<pid>',
+                                 default=None, type=int)
+        self.parser.add_argument('--monitor', '-m', help='Record the peak memory of every node to calibrate the '
+                                                         'estimates of --plan', action='store_true')
+        self.parser.add_argument('--config', '-cf', help='JSON or YAML file answering all the questions of the '
+                                                         'pipeline, for unattended runs; a question without an '
+                                                         'answer stops the run instead of waiting for input',
+                                 default=None, type=os.path.abspath)
         self.parser.add_argument('--debug', '-d', help='Debug mode', action='store_true')
 
     def parse(self) -> argparse.Namespace:
@@ -28,10 +139,49 @@ class Parser:
         return self.args
 
     def _improved_arguments(self) -> argparse.Namespace:
+        if self.args.parallel_subjects < 1:
+            self.parser.error("--parallel_subjects must be at least 1")
+        if (self.args.shard_index is None) != (self.args.shard_count is None):
+            self.parser.error("--shard_index and --shard_count go together")
+        if self.args.shard_count is not None and not 0 <= self.args.shard_index < self.args.shard_count:
+            self.parser.error("--shard_index must be between 0 and --shard_count - 1")
+        if self.args.output_grid == 'custom' and self.args.output_spacing is None:
+            self.parser.error("--output_grid custom requires --output_spacing")
+        if self.args.output_spacing is not None and len(self.args.output_spacing) not in (1, 3):
+            self.parser.error("--output_spacing takes one value or one value per axis")
+        if self.args.crop == 'restore' and self.args.output_grid != 't1':
+            self.parser.error("--crop restore requires --output_grid t1, use --crop declared with other grids")
+        if self.args.crop_padding < 0:
+            self.parser.error("--crop_padding must not be negative")
+        if self.args.subjects_file is not None and not os.path.isfile(self.args.subjects_file):
+            self.parser.error(f"--subjects_file {self.args.subjects_file} does not exist")
+        if self.args.config is not None and not os.path.isfile(self.args.config):
+            self.parser.error(f"--config {self.args.config} does not exist")
         self.args.converted_output = os.path.join(self.args.input, self.args.converted_output)
         self.args.output = os.path.join(self.args.input, self.args.output)
         return self.args
 
+    def is_sharded(self) -> bool:
+        return self.args.shard_count is not None
+
+    def shard_name(self) -> str:
+        return f"shard-{self.args.shard_index}of{self.args.shard_count}" if self.is_sharded() else ""
+
+    def select_shard(self, groups) -> list:
+        """
+        The subjects of this shard, the same for every task given the same subjects. The subjects come in
+        groups which stay in one shard, e.g. the sessions sharing an anatomical pair, and a group is placed
+        by its first subject.
+        """
+        if not self.is_sharded():
+            return [subj for group in groups for subj in group]
+        if self.args.shard_by == 'hash':
+            selected = [group for group in groups if int(hashlib.sha1(group[0].encode()).hexdigest(), 16)
+                        % self.args.shard_count == self.args.shard_index]
+        else:
+            selected = sorted(groups)[self.args.shard_index::self.args.shard_count]
+        return [subj for group in selected for subj in group]
+
     @staticmethod
     def _try_remove(subj, path) -> None:
         try:
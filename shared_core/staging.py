@@ -0,0 +1,55 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SubjectStager:
+    """
+    Copy the inputs of subjects from the shared BIDS folder to node-local scratch in the background.
+    Every staged subject is a one-subject BIDS dataset, <stage root>/<subject>, so the next subject
+    can be prefetched while the current one is processed. folder_of gives the folder of a subject
+    in the dataset, sub-<subject> or sub-<subject>/ses-<session> to stage only one session, or a list
+    of folders to stage several sessions together with the anatomical images they share.
+    """
+
+    def __init__(self, bids_dir, stage_root, folder_of=lambda subject: f"sub-{subject}") -> None:
+        self.bids_dir = bids_dir
+        self.stage_root = stage_root
+        self.folder_of = folder_of
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._staged = {}
+
+    def _stage(self, subject) -> str:
+        target = os.path.join(self.stage_root, subject)
+        folders = self.folder_of(subject)
+        folders = [folders] if isinstance(folders, str) else folders
+        os.makedirs(target, exist_ok=True)
+        shutil.copy(os.path.join(self.bids_dir, "dataset_description.json"), target)
+        for folder in folders:
+            subject_folder = folder.split(os.sep)[0]
+            os.makedirs(os.path.join(target, subject_folder), exist_ok=True)
+            # files at the subject level (e.g. the sessions table) and the folder itself
+            for entry in os.scandir(os.path.join(self.bids_dir, subject_folder)):
+                if entry.is_file():
+                    shutil.copy(entry.path, os.path.join(target, subject_folder))
+            shutil.copytree(os.path.join(self.bids_dir, folder), os.path.join(target, folder), dirs_exist_ok=True)
+        return target
+
+    def prefetch(self, subject) -> None:
+        if subject not in self._staged:
+            self._staged[subject] = self._pool.submit(self._stage, subject)
+
+    def get(self, subject) -> str:
+        """
+        The staged dataset of the subject, waits for the copy to finish.
+        """
+        self.prefetch(subject)
+        return self._staged[subject].result()
+
+    def release(self, subject) -> None:
+        future = self._staged.pop(subject, None)
+        if future is not None:
+            shutil.rmtree(future.result(), ignore_errors=True)
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,77 @@
+import functools
+import hashlib
+import importlib
+import json
+import os
+import shutil
+
+# tool: (executable showing it is installed, module and class of the nipype version probe)
+TOOLS = {
+    "ANTs": ("antsRegistration", "nipype.interfaces.ants.base", "Info"),
+    "FSL": ("fslmaths", "nipype.interfaces.fsl.base", "Info"),
+    "MRtrix3": ("mrconvert", "nipype.interfaces.mrtrix3.base", "Info"),
+    "dcm2niix": ("dcm2niix", "nipype.interfaces.dcm2nii", "Info"),
+}
+
+
+def cache_file() -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "pipeline_registration", "tools.json")
+
+
+def _environment_key() -> str:
+    # the tools found depend on the PATH entries, and the FSL version on FSLDIR
+    entries = os.environ.get("PATH", "").split(os.pathsep) + [os.environ.get("FSLDIR", "")]
+    return hashlib.sha1("\n".join(entries).encode()).hexdigest()
+
+
+def probe_tools(cache_path=None) -> dict:
+    """
+    Paths and versions of the external tools, probed once and cached on disk for the current PATH.
+    A cached entry is used as long as the executable has the same path and modification time.
+    The versions are handed to the nipype Info classes, so the interfaces don't run their version
+    commands again in this process.
+    """
+    cache_path = cache_path or cache_file()
+    cache = {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    key = _environment_key()
+    entries = cache.get(key, {})
+    changed = False
+    for tool, (executable, module, name) in TOOLS.items():
+        path = shutil.which(executable)
+        mtime = os.path.getmtime(path) if path else None
+        entry = entries.get(tool)
+        info = getattr(importlib.import_module(module), name)
+        if entry is None or entry["path"] != path or entry["mtime"] != mtime:
+            entry = {"path": path, "mtime": mtime, "version": info.version() if path else None}
+            entries[tool] = entry
+            changed = True
+        elif entry["version"] is not None:
+            info._version = entry["version"]
+
+    if changed:
+        cache[key] = entries
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, cache_path)
+    return entries
+
+
+@functools.lru_cache(maxsize=None)
+def tool_versions() -> dict:
+    """
+    Versions of nipype and the external tools, None for the ones which are not installed.
+    """
+    import nipype
+
+    versions = {"nipype": nipype.__version__}
+    versions.update({tool: entry["version"] for tool, entry in probe_tools().items()})
+    return versions
@@ -1,17 +1,79 @@
 import functools
 import datetime
-from typing import TypeVar, Callable, cast
+import json
+import os
+import shutil
+from typing import TypeVar, Callable, cast, Optional
 
 TCallable = TypeVar("TCallable", bound=Callable)
 
+# answers of the --config file, None in an interactive run
+_answers = None
 
-def continuously_ask_user_yn(question: str = "", return_bool: bool = False) -> bool or str:
+
+class MissingAnswerError(RuntimeError):
+    pass
+
+
+def load_answers(path: str) -> None:
+    """
+    Answer every question from a JSON or YAML file instead of asking the user.
+    """
+    global _answers
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml  # only needed for YAML config files
+
+            answers = yaml.safe_load(f)
+        else:
+            answers = json.load(f)
+    _answers = answers or {}
+
+
+def get_answer(key: str):
+    """
+    The answer to a question from the config file, keys of nested sections are separated by dots.
+    """
+    value = _answers
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise MissingAnswerError(f"The config file has no answer for '{key}', add it and rerun")
+        value = value[part]
+    return value
+
+
+def has_answers() -> bool:
+    return _answers is not None
+
+
+def ask_user(question: str, key: str) -> str:
+    """
+    Ask for a free-text answer, or take it from the config file.
+    """
+    if has_answers():
+        answer = get_answer(key)
+        print(f"{question}{answer} (from the config file)")
+        return str(answer)
+    return input(question)
+
+
+def continuously_ask_user_yn(question: str = "", return_bool: bool = False, key: Optional[str] = None) -> bool or str:
     """
     Continuously ask the user for a valid answer until one is given.
+    With a config file the answer of key is used, and a missing one raises MissingAnswerError.
     """
     question = question + " [y/n]: "
     while True:
-        answer = input(question)
+        if has_answers():
+            if key is None:
+                raise MissingAnswerError(f"'{question}' can't be answered from a config file")
+            answer = get_answer(key)
+            answer = {True: "y", False: "n"}.get(answer, str(answer))
+            print(f"{question}{answer} (from the config file)")
+            if answer.lower() not in ["y", "n"]:
+                raise MissingAnswerError(f"'{key}' in the config file must be y/n or true/false")
+        else:
+            answer = input(question)
         answer = answer.lower()
         if answer in ["y", "n"]:
             if return_bool:
@@ -37,3 +99,82 @@ def execution_time(func: TCallable) -> TCallable:
         print("Total run time: ", str(datetime.datetime.now() - start))
         return result
     return cast(TCallable, wrapper)
+
+
+FICLONE = 0x40049409
+BLOCK_SIZE = 1024 * 1024
+
+
+def _reflink(src: str, dst: str) -> None:
+    # copy-on-write clone (btrfs, XFS, ...), raises OSError where the filesystem can't do it
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def file_digest(path: str, digest) -> None:
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(block)
+
+
+def _copy(src: str, dst: str, digest=None) -> None:
+    if digest is None:
+        shutil.copyfile(src, dst)
+        return
+    # hash the blocks on their way through instead of reading the file a second time
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        for block in iter(lambda: fsrc.read(BLOCK_SIZE), b""):
+            digest.update(block)
+            fdst.write(block)
+
+
+def transfer_file(src: str, dst: str, mode: str = "copy", digest=None) -> str:
+    """
+    Put src at dst without copying the data where the filesystem allows it.
+    "copy" - a plain copy
+    "link" - a reflink, else a hardlink, else a copy
+    "move" - an atomic rename (src becomes a symlink to dst), else a copy
+    dst is replaced atomically. The content is fed to the hashlib object digest if one is given.
+    Returns the method which was used.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        if digest is not None:
+            file_digest(dst, digest)
+        return "existing"
+    tmp = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{os.getpid()}")
+
+    method = "copy"
+    if mode == "move":
+        try:
+            os.rename(src, dst)
+        except OSError:
+            pass
+        else:
+            # keep the path valid for other nodes reading the same output and for the nipype cache,
+            # the data is at dst already whether or not the link can be made
+            try:
+                os.symlink(dst, src)
+            except OSError as e:
+                print(f"Moved {src} to {dst} but could not link it back: {e}")
+            if digest is not None:
+                file_digest(dst, digest)
+            return "move"
+    elif mode == "link":
+        for method, transfer in (("reflink", _reflink), ("hardlink", os.link)):
+            try:
+                transfer(src, tmp)
+                break
+            except OSError:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        else:
+            method = "copy"
+
+    if method == "copy":
+        _copy(src, tmp, digest)
+    elif digest is not None:
+        file_digest(tmp, digest)
+    os.replace(tmp, dst)
+    return method
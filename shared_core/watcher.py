@@ -0,0 +1,74 @@
+import glob
+import os
+import time
+
+
+def has_required_modalities(folder) -> bool:
+    """
+    A subject or session folder with a T1w, a T2w and a DWI with its gradients. A session
+    without anatomical images uses those of its subject.
+    """
+    required = [os.path.join("dwi", "*_dwi.nii*"),
+                os.path.join("dwi", "*_dwi.bval"),
+                os.path.join("dwi", "*_dwi.bvec")]
+    anatomical = [os.path.join("anat", "*_T1w.nii*"),
+                  os.path.join("anat", "*_T2w.nii*")]
+    anat_folder = os.path.dirname(folder) if os.path.basename(folder).startswith("ses-") else folder
+    return (all(glob.glob(os.path.join(folder, "**", pattern), recursive=True) for pattern in required) and
+            all(glob.glob(os.path.join(anat_folder, "**", pattern), recursive=True) for pattern in anatomical))
+
+
+class FolderWatcher:
+    """
+    Poll a BIDS folder for new subject (or session) folders. A folder is ready once it has all
+    the required modalities and none of its files has changed for settle_seconds, so scans which
+    are still being copied are not picked up. A folder is reported again when its files change.
+    """
+
+    def __init__(self, root, settle_seconds=120, is_complete=has_required_modalities) -> None:
+        self.root = root
+        self.settle_seconds = settle_seconds
+        self.is_complete = is_complete
+
+        self._seen = {}
+        self._processed = {}
+
+    def units(self) -> list:
+        # session folders where a subject has them, otherwise the subject folder
+        found = []
+        for subject in sorted(glob.glob(os.path.join(self.root, "sub-*"))):
+            if not os.path.isdir(subject):
+                continue
+            sessions = sorted(s for s in glob.glob(os.path.join(subject, "ses-*")) if os.path.isdir(s))
+            found.extend(sessions or [subject])
+        return [os.path.relpath(unit, self.root) for unit in found]
+
+    def _signature(self, unit) -> tuple:
+        signature = []
+        for root, _, files in os.walk(os.path.join(self.root, unit)):
+            for fn in files:
+                try:
+                    st = os.stat(os.path.join(root, fn))
+                except FileNotFoundError:
+                    continue
+                signature.append((os.path.join(root, fn), st.st_size, st.st_mtime))
+        return tuple(sorted(signature))
+
+    def mark_processed(self, units) -> None:
+        for unit in units:
+            self._processed[unit] = self._signature(unit)
+
+    def poll(self) -> list:
+        now = time.time()
+        ready = []
+        for unit in self.units():
+            signature = self._signature(unit)
+            if unit not in self._seen or self._seen[unit][0] != signature:
+                self._seen[unit] = (signature, now)
+                continue
+            if now - self._seen[unit][1] < self.settle_seconds or self._processed.get(unit) == signature:
+                continue
+            if self.is_complete(os.path.join(self.root, unit)):
+                self._processed[unit] = signature
+                ready.append(unit)
+        return ready
@@ -0,0 +1,135 @@
+import json
+import os
+import socket
+import threading
+import time
+from typing import Optional
+
+
+class WorkQueue:
+    """
+    Work queue in a directory on a shared filesystem, no server or scheduler needed.
+    Items move between the pending, claimed, done and failed subfolders with atomic renames,
+    so any number of workers on any host can claim them. A claimed item is a lease: the worker
+    keeps touching it, and a lease that has not been touched for lease_seconds is put back to pending.
+    """
+
+    def __init__(self, queue_dir, lease_seconds=600) -> None:
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+        self.pending = os.path.join(queue_dir, "pending")
+        self.claimed = os.path.join(queue_dir, "claimed")
+        self.done = os.path.join(queue_dir, "done")
+        self.failed = os.path.join(queue_dir, "failed")
+        for folder in (self.pending, self.claimed, self.done, self.failed):
+            os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def _name(fn) -> str:
+        # files are <order>_<id>.json, leases <order>_<id>__<worker>.json
+        return fn.split("__")[0].replace(".json", "")
+
+    def _ids(self, folder) -> dict:
+        return {self._name(fn).split("_", 1)[1]: fn for fn in os.listdir(folder) if fn.endswith(".json")}
+
+    def publish(self, items) -> int:
+        """
+        Add items (dicts with a unique "id") in the given order, items which are already queued,
+        running or done are skipped and failed items are queued again.
+        """
+        known = set(self._ids(self.pending)) | set(self._ids(self.claimed)) | set(self._ids(self.done))
+        failed = self._ids(self.failed)
+        published = 0
+        for order, item in enumerate(items):
+            if item["id"] in known:
+                continue
+            if item["id"] in failed:
+                os.remove(os.path.join(self.failed, failed[item["id"]]))
+            name = f"{order:06d}_{item['id']}.json"
+            tmp = os.path.join(self.queue_dir, f".{name}.{self.worker_id}")
+            with open(tmp, "w") as f:
+                json.dump(item, f)
+            os.replace(tmp, os.path.join(self.pending, name))
+            published += 1
+        return published
+
+    def claim(self) -> Optional[dict]:
+        self.requeue_expired()
+        for fn in sorted(os.listdir(self.pending)):
+            if not fn.endswith(".json"):
+                continue
+            lease = os.path.join(self.claimed, f"{self._name(fn)}__{self.worker_id}.json")
+            try:
+                # only one worker wins the rename, the others get FileNotFoundError
+                os.rename(os.path.join(self.pending, fn), lease)
+            except FileNotFoundError:
+                continue
+            os.utime(lease)
+            with open(lease) as f:
+                item = json.load(f)
+            item["_lease"] = lease
+            return item
+        return None
+
+    def heartbeat(self, item) -> None:
+        os.utime(item["_lease"])
+
+    def complete(self, item) -> None:
+        os.rename(item["_lease"], os.path.join(self.done, self._name(os.path.basename(item["_lease"])) + ".json"))
+
+    def fail(self, item, error) -> None:
+        record = {key: value for key, value in item.items() if key != "_lease"}
+        record["error"] = str(error)
+        record["worker"] = self.worker_id
+        with open(item["_lease"], "w") as f:
+            json.dump(record, f)
+        os.rename(item["_lease"], os.path.join(self.failed, self._name(os.path.basename(item["_lease"])) + ".json"))
+
+    def requeue_expired(self) -> None:
+        now = time.time()
+        for fn in os.listdir(self.claimed):
+            lease = os.path.join(self.claimed, fn)
+            try:
+                expired = now - os.path.getmtime(lease) > self.lease_seconds
+                if expired:
+                    os.rename(lease, os.path.join(self.pending, self._name(fn) + ".json"))
+                    print(f"Lease of {fn} expired, queued again")
+            except FileNotFoundError:
+                continue
+
+    def has_claimed(self) -> bool:
+        return any(fn.endswith(".json") for fn in os.listdir(self.claimed))
+
+    def status(self) -> dict:
+        return {name: len(os.listdir(folder)) for name, folder in
+                (("pending", self.pending), ("claimed", self.claimed), ("done", self.done), ("failed", self.failed))}
+
+
+class LeaseKeeper:
+    """
+    Context manager touching the lease of an item in the background while it is processed.
+    """
+
+    def __init__(self, queue, item) -> None:
+        self.queue = queue
+        self.item = item
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.heartbeat(self.item)
+            except FileNotFoundError:
+                # the lease expired and was taken over, nothing to keep alive anymore
+                return
+
+    def __enter__(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()